@@ -0,0 +1,382 @@
+import codecs
+import csv
+import io
+import json
+import os
+import tempfile
+import zipfile
+from typing import AsyncIterator, Dict, Iterator, List, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import select, func, or_, tuple_
+from starlette.concurrency import run_in_threadpool
+
+from db import User, Applications, ApplicationAssignment, Submission, Attachment, async_session_maker, dialect_insert, attachment_ids, user_emails
+from schemas import BulkApplication, BulkAssignment
+from users import current_active_user
+from leaderboard import check_board_access
+from catalog import catalog
+from events import json_default
+from storage import storage, original_key
+import versions
+
+# rows per transaction, and the most rows one import may contain
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", "500"))
+BULK_MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", "100000"))
+
+# rows fetched from the server-side cursor at a time when exporting
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+EXPORT_FIELDS = ["id", "application_id", "user_id", "email", "submission", "attachments", "created_at"]
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+def require_superuser(user: User = Depends(current_active_user)) -> User:
+    if not user.is_superuser:
+        raise HTTPException(status_code=403, detail="User is not superuser")
+    return user
+
+
+# imports are sent as a JSON array, as a CSV or NDJSON body, or as a CSV/NDJSON file in a
+# multipart form. files and bodies are spooled to disk and parsed row by row, so a large
+# import never sits in memory as a whole
+
+def detect_format(content_type: str, filename: str = "") -> str:
+    if content_type.startswith("text/csv") or filename.endswith(".csv"):
+        return "csv"
+    if content_type.startswith(("application/x-ndjson", "application/ndjson", "application/jsonl")) or filename.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    if content_type.startswith("application/json") or filename.endswith(".json"):
+        return "json"
+    raise HTTPException(status_code=415, detail="Send a JSON array, CSV or NDJSON")
+
+
+def parse_rows(file, fmt: str) -> Iterator[Tuple[int, dict]]:
+    # (row number, raw row) pairs, numbered from 1. a row that cannot be parsed comes back as
+    # {"__error__": reason} so it is reported without aborting the import
+    if fmt == "json":
+        try:
+            rows = json.load(file)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body is not valid JSON")
+        if not isinstance(rows, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array")
+        yield from enumerate(rows, start=1)
+        return
+    text = codecs.getreader("utf-8-sig")(file)
+    if fmt == "csv":
+        # empty cells mean "not given", the same as a missing JSON key
+        for number, row in enumerate(csv.DictReader(text), start=1):
+            yield number, {key: value for key, value in row.items() if key and value not in ("", None)}
+        return
+    number = 0
+    for line in text:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, {"__error__": "Line is not valid JSON"}
+
+
+def check_row_count(file, fmt: str):
+    # the whole import is spooled before any of it is written, so an import over the limit is
+    # turned away up front instead of after its first batches have committed
+    for number, _ in parse_rows(file, fmt):
+        if number > BULK_MAX_ROWS:
+            raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ROWS} rows per import")
+    file.seek(0)
+
+
+async def spool_rows(request: Request) -> Iterator[Tuple[int, dict]]:
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing file")
+        file, fmt = upload.file, detect_format(upload.content_type or "", upload.filename or "")
+    else:
+        fmt = detect_format(content_type)
+        file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        async for chunk in request.stream():
+            file.write(chunk)
+        file.seek(0)
+    await run_in_threadpool(check_row_count, file, fmt)
+    return parse_rows(file, fmt)
+
+
+def validate_rows(rows: Iterator[Tuple[int, dict]], model, report: List[dict]) -> Iterator[List[Tuple[int, BaseModel]]]:
+    # valid rows in batches; invalid ones go straight into the report
+    batch = []
+    for number, row in rows:
+        if not isinstance(row, dict):
+            report.append({"row": number, "status": "error", "detail": "Expected an object"})
+            continue
+        if "__error__" in row:
+            report.append({"row": number, "status": "error", "detail": row["__error__"]})
+            continue
+        try:
+            batch.append((number, model.model_validate(row)))
+        except ValidationError as e:
+            report.append({"row": number, "status": "error", "detail": "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())})
+            continue
+        if len(batch) == BULK_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def dedupe(batch: list, key, report: List[dict]) -> list:
+    # one statement cannot upsert the same key twice, the last row for a key wins
+    last = {}
+    for number, item in batch:
+        previous = last.get(key(item))
+        if previous is not None:
+            report.append({"row": previous[0], "status": "skipped", "detail": f"Superseded by row {number}"})
+        last[key(item)] = (number, item)
+    return list(last.values())
+
+
+def summarize(report: List[dict]) -> dict:
+    report.sort(key=lambda row: row["row"])
+    counts = {status: 0 for status in ("created", "updated", "skipped", "error")}
+    for row in report:
+        counts[row["status"]] += 1
+    return {"total": len(report), **counts, "rows": report}
+
+
+@router.post("/applications/bulk")
+async def bulk_import_applications(request: Request, user: User = Depends(require_superuser)):
+    # upserts by name: existing applications are updated, new ones created
+    report = []
+    for batch in validate_rows(await spool_rows(request), BulkApplication, report):
+        batch = dedupe(batch, lambda item: item.name, report)
+        names = [item.name for _, item in batch]
+        async with async_session_maker() as session:
+            try:
+                result = await session.execute(select(Applications.name).where(Applications.name.in_(names)))
+                existing = set(result.scalars())
+                stmt = dialect_insert(Applications).values([item.model_dump() for _, item in batch])
+                await session.execute(stmt.on_conflict_do_update(
+                    index_elements=[Applications.name],
+                    set_={column: stmt.excluded[column] for column in ("is_active", "description", "instructions")}))
+                await versions.bump(session, versions.CATALOG)
+                result = await session.execute(select(Applications.name, Applications.id).where(Applications.name.in_(names)))
+                ids = dict(result.all())
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                report.extend({"row": number, "status": "error", "detail": f"Batch failed: {e.__class__.__name__}"} for number, _ in batch)
+                continue
+        report.extend(
+            {"row": number, "status": "updated" if item.name in existing else "created", "application_id": ids.get(item.name)}
+            for number, item in batch)
+    catalog.invalidate()
+    return summarize(report)
+
+
+async def resolve_assignments(session, batch: List[Tuple[int, BulkAssignment]], report: List[dict]) -> List[Tuple[int, BulkAssignment]]:
+    # fills in user_id and application_id and checks that both exist: one query for the users,
+    # one for the applications, whether they are given by id or by email and name
+    emails = {item.email.lower() for _, item in batch if item.user_id is None and item.email}
+    user_ids = {item.user_id for _, item in batch if item.user_id is not None}
+    names = {item.application for _, item in batch if item.application_id is None and item.application}
+    application_ids = {item.application_id for _, item in batch if item.application_id is not None}
+
+    result = await session.execute(
+        select(User.id, func.lower(User.email)).
+        where(or_(User.id.in_(user_ids), func.lower(User.email).in_(emails))))
+    users = result.all()
+    known_users = {user_id for user_id, _ in users}
+    users_by_email: Dict[str, object] = {email: user_id for user_id, email in users}
+    result = await session.execute(
+        select(Applications.id, Applications.name).
+        where(or_(Applications.id.in_(application_ids), Applications.name.in_(names))))
+    applications = result.all()
+    known_applications = {application_id for application_id, _ in applications}
+    applications_by_name: Dict[str, int] = {name: application_id for application_id, name in applications}
+
+    resolved = []
+    for number, item in batch:
+        if item.user_id is None:
+            item.user_id = users_by_email.get((item.email or "").lower())
+        if item.application_id is None:
+            item.application_id = applications_by_name.get(item.application)
+        if item.user_id not in known_users:
+            report.append({"row": number, "status": "error", "detail": "User not found" if item.email or item.user_id else "email or user_id is required"})
+        elif item.application_id not in known_applications:
+            report.append({"row": number, "status": "error", "detail": "Application not found" if item.application or item.application_id else "application_id or application is required"})
+        else:
+            resolved.append((number, item))
+    return resolved
+
+
+@router.post("/application_assignments/bulk")
+async def bulk_import_assignments(request: Request, user: User = Depends(require_superuser)):
+    # upserts by (user, application): existing assignments get the new is_admin
+    report = []
+    for batch in validate_rows(await spool_rows(request), BulkAssignment, report):
+        async with async_session_maker() as session:
+            batch = await resolve_assignments(session, batch, report)
+            batch = dedupe(batch, lambda item: (item.user_id, item.application_id), report)
+            if not batch:
+                continue
+            keys = [(item.user_id, item.application_id) for _, item in batch]
+            try:
+                result = await session.execute(
+                    select(ApplicationAssignment.user_id, ApplicationAssignment.application_id).
+                    where(tuple_(ApplicationAssignment.user_id, ApplicationAssignment.application_id).in_(keys)))
+                existing = set(result.all())
+                stmt = dialect_insert(ApplicationAssignment).values([
+                    {"user_id": item.user_id, "application_id": item.application_id, "is_admin": item.is_admin}
+                    for _, item in batch])
+                await session.execute(stmt.on_conflict_do_update(
+                    index_elements=[ApplicationAssignment.user_id, ApplicationAssignment.application_id],
+                    set_={"is_admin": stmt.excluded.is_admin}))
+                await versions.bump(session, *sorted({versions.user_key(item.user_id) for _, item in batch}))
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                report.extend({"row": number, "status": "error", "detail": f"Batch failed: {e.__class__.__name__}"} for number, _ in batch)
+                continue
+        report.extend(
+            {"row": number, "status": "updated" if (item.user_id, item.application_id) in existing else "created",
+             "user_id": item.user_id, "application_id": item.application_id}
+            for number, item in batch)
+    return summarize(report)
+
+
+# exports stream from a server-side cursor one partition at a time, so memory use does not
+# grow with the number of submissions and the first rows go out before the query is done
+
+async def submission_partitions(application_id: int, *columns) -> AsyncIterator[list]:
+    async with async_session_maker() as session:
+        result = await session.stream(
+            select(*columns).
+            where(Submission.application_id == application_id).
+            order_by(Submission.id).
+            execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for partition in result.partitions():
+            yield partition
+
+
+async def export_rows(application_id: int) -> AsyncIterator[List[dict]]:
+    # submissions with the submitter's email, looked up per partition for users not seen yet
+    emails = {}
+    async with async_session_maker() as lookup:
+        columns = [Submission.id, Submission.application_id, Submission.user_id, Submission.submission, Submission.attachments, Submission.created_at]
+        async for partition in submission_partitions(application_id, *columns):
+            emails.update(await user_emails(lookup, {row.user_id for row in partition} - emails.keys()))
+            yield [{**row._mapping, "email": emails.get(row.user_id)} for row in partition]
+
+
+def ndjson_lines(rows: List[dict]) -> str:
+    return "".join(json.dumps({field: row[field] for field in EXPORT_FIELDS}, default=json_default) + "\n" for row in rows)
+
+
+async def export_ndjson(application_id: int):
+    async for rows in export_rows(application_id):
+        yield ndjson_lines(rows)
+
+
+def csv_cell(field: str, value):
+    # the attachment list stays JSON inside its cell
+    if field == "attachments":
+        return json.dumps(value)
+    if value is None:
+        return ""
+    return json_default(value) if field in ("user_id", "created_at") else value
+
+
+async def export_csv(application_id: int):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    async for rows in export_rows(application_id):
+        for row in rows:
+            writer.writerow([csv_cell(field, row[field]) for field in EXPORT_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class ZipBuffer:
+    # write-only file for ZipFile; without seek and tell it streams entries with data descriptors,
+    # and the generator hands out whatever has been written after every step
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def export_zip(application_id: int):
+    # submissions.ndjson, then every referenced file once under attachments/
+    buffer = ZipBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("submissions.ndjson", mode="w", force_zip64=True) as entry:
+            async for rows in export_rows(application_id):
+                entry.write(ndjson_lines(rows).encode())
+                yield buffer.drain()
+
+        seen = set()
+        async with async_session_maker() as lookup:
+            async for partition in submission_partitions(application_id, Submission.attachments):
+                referenced = set().union(*(attachment_ids(row.attachments) for row in partition)) - seen
+                if not referenced:
+                    continue
+                seen |= referenced
+                result = await lookup.execute(select(Attachment.id, Attachment.mime_type).where(Attachment.id.in_(referenced)))
+                for attachment_id, mime_type in result.all():
+                    key = original_key(attachment_id, mime_type)
+                    if not await storage.exists(key):
+                        continue
+                    # images are already compressed
+                    info = zipfile.ZipInfo(f"attachments/{key}")
+                    info.compress_type = zipfile.ZIP_STORED
+                    with archive.open(info, mode="w") as entry:
+                        async for chunk in storage.iter_chunks(key):
+                            entry.write(chunk)
+                            yield buffer.drain()
+    yield buffer.drain()
+
+
+EXPORT_FORMATS = {
+    "ndjson": (export_ndjson, "application/x-ndjson"),
+    "csv": (export_csv, "text/csv"),
+    "zip": (export_zip, "application/zip"),
+}
+
+
+@router.get("/applications/{application_id}/export")
+async def export_submissions(application_id: int, format: str = "ndjson", user: User = Depends(current_active_user)):
+    # every submission of an application, for superusers and the application's admins
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {list(EXPORT_FORMATS)}")
+    async with async_session_maker() as session:
+        result = await session.execute(select(Applications.id).where(Applications.id == application_id))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Application not found")
+        await check_board_access(session, application_id, user, admin=True)
+    export, media_type = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export(application_id),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="application-{application_id}-submissions.{format}"'})
@@ -0,0 +1,135 @@
+import asyncio
+import math
+import os
+import time
+from typing import Dict, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from cache import LRUCache
+from metrics import Counter, Collected
+from users import token_subject
+
+# admission control for the expensive routes, so a burst of uploads queues or gets shed instead of
+# slowing every endpoint down. it runs as a middleware, before the request body is received: a
+# dependency would only run after FastAPI has read and spooled the whole multipart body.
+# each controller is configured from ADMISSION_<NAME>_<SETTING>:
+#   CONCURRENCY  requests handled at once
+#   QUEUE        requests allowed to wait for a slot, beyond that they get a 503
+#   TIMEOUT      seconds a request waits for a slot before it gets a 503
+#   RATE, BURST  per user token bucket: RATE requests per second on average, BURST at once (429)
+
+admission_rejected = Counter("admission_rejected_total", "Requests turned away by admission control", ["controller", "reason"])
+controllers = {}
+
+
+def setting(name: str, key: str, default: float) -> float:
+    return float(os.environ.get(f"ADMISSION_{name.upper()}_{key}", str(default)))
+
+
+class Admission:
+
+    def __init__(self, name: str, concurrency: int, queue: int, timeout: float, rate: float, burst: int):
+        self.name = name
+        self.concurrency = int(setting(name, "CONCURRENCY", concurrency))
+        self.queue = int(setting(name, "QUEUE", queue))
+        self.timeout = setting(name, "TIMEOUT", timeout)
+        self.rate = setting(name, "RATE", rate)
+        self.burst = setting(name, "BURST", burst)
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # user id -> (tokens, monotonic time they were counted at)
+        self._buckets = LRUCache(maxsize=int(os.environ.get("ADMISSION_BUCKETS", "100000")))
+        controllers[name] = self
+
+    def reject(self, status_code: int, reason: str, retry_after: float, detail: str):
+        admission_rejected.inc(self.name, reason)
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def take_token(self, key):
+        # a full bucket for users we haven't seen, refilled at rate tokens per second
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets.set(key, (tokens, now))
+            self.reject(429, "rate", (1 - tokens) / self.rate, "Too many requests, slow down")
+        self._buckets.set(key, (tokens - 1, now))
+
+    async def enter(self):
+        # a free slot is taken at once; otherwise wait in a bounded queue for a bounded time
+        if self._semaphore.locked():
+            if self.waiting >= self.queue:
+                self.reject(503, "queue_full", self.timeout, "Server is busy, try again shortly")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self.reject(503, "timeout", self.timeout, "Server is busy, try again shortly")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+
+    def leave(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    async def admit(self, user_id: str):
+        if self.rate > 0:
+            self.take_token(user_id)
+        await self.enter()
+
+
+class AdmissionMiddleware:
+    # routes maps (method, path) to the controller guarding it
+
+    def __init__(self, app, routes: Dict[Tuple[str, str], Admission]):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        controller = self.routes.get((scope["method"], scope["path"])) if scope["type"] == "http" else None
+        if controller is None:
+            return await self.app(scope, receive, send)
+        try:
+            # the buckets are per user, from the token alone; the route still checks the user
+            user_id = token_subject(Request(scope))
+            if user_id is None:
+                raise HTTPException(status_code=401, detail="Unauthorized")
+            await controller.admit(user_id)
+        except HTTPException as e:
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+            return await response(scope, receive, send)
+
+        # the slot covers receiving the body and the route, it is released once the response starts
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                controller.leave()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                release()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            release()
+
+Collected("admission_active", "Requests holding an admission slot", "gauge", ["controller"],
+          lambda: {(name,): controller.active for name, controller in controllers.items()})
+Collected("admission_waiting", "Requests queued for an admission slot", "gauge", ["controller"],
+          lambda: {(name,): controller.waiting for name, controller in controllers.items()})
+
+# uploads decode images and hold buffers: few at a time, a short queue and a modest rate per user
+upload_admission = Admission("upload", concurrency=8, queue=32, timeout=10, rate=1, burst=10)
+# submissions without files are cheap, this only stops single users from flooding
+submission_admission = Admission("submission", concurrency=32, queue=128, timeout=10, rate=2, burst=20)
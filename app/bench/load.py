@@ -0,0 +1,246 @@
+# load test of the hot endpoints against the app in-process, on a throwaway database
+#
+#   cd app && python -m bench.load [--concurrency 10] [--requests 200] [--output run.json] [--compare old.json]
+#
+# every run starts from a temp data directory and SQLite database seeded with synthetic users,
+# applications, submissions and PNG attachments. each scenario sends --requests requests from
+# --concurrency concurrent clients and reports throughput and p50/p95/p99 latency. --output
+# stores the report as JSON, --compare prints the change against an earlier report
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+from PIL import Image
+
+PASSWORD = "bench-password"
+SCENARIOS = [
+    "login",
+    "applications_me",
+    "submission_list",
+    "submission_create",
+    "upload_attachment",
+    "attachment_original",
+    "attachment_thumbnail",
+]
+
+
+def setup_environment() -> str:
+    # the app reads its configuration at import time, so this runs before main is imported.
+    # not at module level: the image worker processes import this module too
+    bench_dir = tempfile.mkdtemp(prefix="scoreboard-bench-")
+    os.environ["DATA_DIR"] = os.path.join(bench_dir, "data")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{bench_dir}/bench.db"
+    os.environ["RUN_MIGRATIONS_ON_STARTUP"] = "true"
+    os.environ.setdefault("SECRET", "bench-secret-bench-secret-bench-secret")
+    # a handful of seeded users send every request, per user rate limits would turn them into 429s
+    os.environ.setdefault("ADMISSION_UPLOAD_RATE", "0")
+    os.environ.setdefault("ADMISSION_SUBMISSION_RATE", "0")
+    os.makedirs(os.environ["DATA_DIR"])
+    return bench_dir
+
+
+def png(size: int = 256) -> bytes:
+    # random noise, so every upload is a new blob instead of a dedupe hit
+    image = Image.frombytes("RGB", (size, size), random.randbytes(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def check(response: httpx.Response) -> httpx.Response:
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.method} {response.request.url.path}: {response.status_code} {response.text}")
+    return response
+
+
+async def login(client: httpx.AsyncClient, email: str) -> dict:
+    response = check(await client.post("/auth/jwt-api/login", data={"username": email, "password": PASSWORD}))
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def seed(client: httpx.AsyncClient, args) -> dict:
+    from schemas import UserCreate
+    from users import get_user_manager_manual
+
+    admin_email = "bench-admin@example.com"
+    emails = [f"bench-{i}@example.com" for i in range(args.users)]
+    async for manager in get_user_manager_manual():
+        await manager.create(UserCreate(email=admin_email, password=PASSWORD, is_superuser=True))
+        for email in emails:
+            await manager.create(UserCreate(email=email, password=PASSWORD))
+
+    admin = await login(client, admin_email)
+    names = [f"bench application {i}" for i in range(args.applications)]
+    response = check(await client.post("/admin/applications/bulk", json=[{"name": name} for name in names], headers=admin))
+    applications = [row["application_id"] for row in response.json()["rows"]]
+    check(await client.post("/admin/application_assignments/bulk", json=[
+        {"email": email, "application_id": application_id} for email in emails for application_id in applications], headers=admin))
+
+    users = []
+    for email in emails:
+        headers = await login(client, email)
+        response = check(await client.post("/upload_attachment", files={"fileAttach": ("seed.png", png(), "image/png")}, data={"desc": "seed"}, headers=headers))
+        attachments = [str(attachment) for attachment in response.json()["uuids"]]
+        for i in range(args.submissions):
+            check(await client.post("/application_submission", json={
+                "application_id": applications[i % len(applications)],
+                "submission": f"seed submission {i}",
+                "attachments": json.dumps(attachments if i == 0 else []),
+            }, headers=headers))
+        users.append({"email": email, "headers": headers, "attachments": attachments})
+    # thumbnails are generated in the background, wait so the fetches measure serving them
+    for user in users:
+        for attachment in user["attachments"]:
+            await client.get(f"/attachments/data/{attachment}_thumbnail.jpg", headers=user["headers"])
+    return {"users": users, "applications": applications}
+
+
+def scenario_request(name: str, client: httpx.AsyncClient, fixtures: dict, image: bytes):
+    user = random.choice(fixtures["users"])
+    headers = user["headers"]
+    application_id = random.choice(fixtures["applications"])
+    if name == "login":
+        return client.post("/auth/jwt-api/login", data={"username": user["email"], "password": PASSWORD})
+    if name == "applications_me":
+        return client.get("/applications/me", headers=headers)
+    if name == "submission_list":
+        return client.get("/application_submission", params={"application_id": application_id}, headers=headers)
+    if name == "submission_create":
+        return client.post("/application_submission", json={"application_id": application_id, "submission": "bench", "attachments": "[]"}, headers=headers)
+    if name == "upload_attachment":
+        return client.post("/upload_attachment", files={"fileAttach": ("bench.png", image, "image/png")}, data={"desc": "bench"}, headers=headers)
+    if name == "attachment_original":
+        return client.get(f"/attachments/data/{user['attachments'][0]}", headers=headers)
+    if name == "attachment_thumbnail":
+        return client.get(f"/attachments/data/{user['attachments'][0]}_thumbnail.jpg", headers=headers)
+    raise ValueError(f"Unknown scenario {name}")
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    # nearest rank on the sorted latencies
+    index = max(0, min(len(latencies) - 1, round(fraction * len(latencies)) - 1))
+    return latencies[index]
+
+
+async def run_scenario(name: str, client: httpx.AsyncClient, fixtures: dict, args) -> dict:
+    # uploads get fresh images, generated up front so encoding them is not part of the timing
+    images = [png() for _ in range(min(args.requests, 50))] if name == "upload_attachment" else [b""]
+    latencies = []
+    errors = 0
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            request = scenario_request(name, client, fixtures, random.choice(images))
+            start = time.perf_counter()
+            response = await request
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": args.concurrency,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict, baseline: dict = None):
+    header = f"{'scenario':<22}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+    if baseline:
+        header += f"{'rps Δ':>9}{'p95 Δ':>9}"
+    print(header)
+    for name, result in report["results"].items():
+        line = f"{name:<22}{result['throughput_rps']:>9}{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}{result['errors']:>8}"
+        before = (baseline or {}).get("results", {}).get(name)
+        if before:
+            line += f"{change(before['throughput_rps'], result['throughput_rps']):>9}{change(before['p95_ms'], result['p95_ms']):>9}"
+        print(line)
+
+
+def change(before: float, after: float) -> str:
+    return f"{(after - before) / before * 100:+.0f}%" if before else "-"
+
+
+async def main(args):
+    from main import app
+
+    scenarios = args.scenarios.split(",") if args.scenarios else SCENARIOS
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios {unknown}, choose from {SCENARIOS}")
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            fixtures = await seed(client, args)
+            results = {}
+            for name in scenarios:
+                results[name] = await run_scenario(name, client, fixtures, args)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the hot endpoints in-process")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--applications", type=int, default=5)
+    parser.add_argument("--submissions", type=int, default=20, help="seeded submissions per user")
+    parser.add_argument("--scenarios", help=f"comma separated, default all of {','.join(SCENARIOS)}")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    bench_dir = setup_environment()
+    try:
+        asyncio.run(main(args))
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
@@ -0,0 +1,91 @@
+# serialization cost of the listing endpoints per 1k rows, before and after the response models
+#
+#   cd app && python -m bench.serialization [rows] [repeat]
+#
+# before: FastAPI walks the returned objects with jsonable_encoder and json.dumps the result
+# after:  FastAPI validates into the response model and pydantic-core dumps straight to bytes
+import json
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from db import Applications, Submission
+from schemas import ApplicationPage, SubmissionPage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_applications(rows: int):
+    return [
+        Applications(id=i, name=f"application {i}", is_active=True, description="description " * 10, instructions="instructions " * 10)
+        for i in range(rows)
+    ]
+
+
+def make_submissions(rows: int):
+    user_id = uuid.uuid4()
+    start = datetime(2024, 1, 1)
+    return [
+        Submission(
+            id=i, application_id=i % 10, user_id=user_id, submission="submission text " * 8,
+            attachments=[str(uuid.uuid4()) for _ in range(2)], created_at=start + timedelta(seconds=i))
+        for i in range(rows)
+    ]
+
+
+def as_dicts(objects, columns):
+    # what the projected listings hand to FastAPI
+    return [{column: getattr(obj, column) for column in columns} for obj in objects]
+
+
+def before(content):
+    return json.dumps(jsonable_encoder(content)).encode()
+
+
+def after(adapter: TypeAdapter, content):
+    return adapter.dump_json(adapter.validate_python(content, from_attributes=True), exclude_unset=True)
+
+
+def with_orjson(content):
+    # the plain orjson encoder for reference, it needs plain types so the encoder runs first
+    return orjson.dumps(jsonable_encoder(content))
+
+
+def measure(fn, rows: int, repeat: int) -> float:
+    # best of repeat runs, in milliseconds per 1k rows
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000 * 1000 / rows
+
+
+def main(rows: int = 1000, repeat: int = 20):
+    applications = make_applications(rows)
+    submissions = make_submissions(rows)
+    cases = {
+        "applications (orm)": (TypeAdapter(ApplicationPage), {"applications": applications, "next_cursor": None}),
+        "submissions (orm)": (TypeAdapter(SubmissionPage), {"submissions": submissions, "next_cursor": None}),
+        "submissions (dict)": (TypeAdapter(SubmissionPage), {"submissions": as_dicts(submissions, ["id", "created_at", "submission", "attachments"]), "next_cursor": None}),
+    }
+    results = {}
+    print(f"{'case':<22}{'before':>10}{'after':>10}{'orjson':>10}   ms per 1k rows")
+    for name, (adapter, content) in cases.items():
+        # both paths must produce the same document
+        assert json.loads(before(content)) == json.loads(after(adapter, content)), name
+        results[name] = {
+            "before": measure(lambda: before(content), rows, repeat),
+            "after": measure(lambda: after(adapter, content), rows, repeat),
+            "orjson": measure(lambda: with_orjson(content), rows, repeat) if orjson else None,
+        }
+        row = results[name]
+        orjson_ms = f"{row['orjson']:>10.2f}" if row["orjson"] is not None else f"{'-':>10}"
+        print(f"{name:<22}{row['before']:>10.2f}{row['after']:>10.2f}{orjson_ms}")
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import time
+from bisect import bisect_right
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+
+from db import Applications, async_session_maker
+import versions
+
+# how stale another worker's view of the catalog may get; the worker that wrote is current at once
+CATALOG_POLL_INTERVAL = float(os.environ.get("CATALOG_POLL_INTERVAL", "1")) # seconds
+
+
+def application_summary(application: Applications) -> dict:
+    return {
+        "id": application.id,
+        "name": application.name,
+        "is_active": application.is_active,
+        "description": application.description,
+        "instructions": application.instructions,
+    }
+
+
+class ApplicationCatalog:
+    # every application by id. the table is small and only superusers write to it, so each worker
+    # keeps all of it and polls the catalog data version to learn about other workers' writes
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.version: Optional[int] = None
+        self._applications: Dict[int, dict] = {}
+        self._ids: List[int] = []
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        async with async_session_maker() as session:
+            # the version is read first: a write landing in between only causes one more reload
+            version = (await versions.current(session, versions.CATALOG))[versions.CATALOG]
+            result = await session.execute(select(Applications))
+            applications = {application.id: application_summary(application) for application in result.scalars()}
+        self._applications = applications
+        self._ids = sorted(applications)
+        self.version = version
+        self._checked_at = time.monotonic()
+
+    async def refresh(self):
+        # at most one primary key lookup per poll interval, a reload only after a write
+        if time.monotonic() - self._checked_at < self.poll_interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._checked_at < self.poll_interval:
+                return
+            async with async_session_maker() as session:
+                version = (await versions.current(session, versions.CATALOG))[versions.CATALOG]
+            if version != self.version:
+                await self.load()
+            else:
+                self._checked_at = time.monotonic()
+
+    def put(self, application: dict):
+        # write-through after a commit in this worker. the version bump that came with the write
+        # makes the next poll reload once, which also picks up anything else that changed
+        if application["id"] not in self._applications:
+            self._ids = sorted([*self._ids, application["id"]])
+        self._applications = {**self._applications, application["id"]: application}
+
+    def invalidate(self):
+        # for writes that touch many rows at once, e.g. bulk imports
+        self._checked_at = 0.0
+        self.version = None
+
+    async def get(self, application_id: int) -> Optional[dict]:
+        await self.refresh()
+        return self._applications.get(application_id)
+
+    async def page(self, after: Optional[int], limit: int) -> List[dict]:
+        # applications in id order after the given id, like the keyset listing they replace
+        await self.refresh()
+        start = 0 if after is None else bisect_right(self._ids, after)
+        applications = self._applications
+        return [applications[application_id] for application_id in self._ids[start:start + limit] if application_id in applications]
+
+    async def lookup(self, application_ids: List[int]) -> Dict[int, dict]:
+        await self.refresh()
+        applications = self._applications
+        return {application_id: applications[application_id] for application_id in application_ids if application_id in applications}
+
+
+catalog = ApplicationCatalog(CATALOG_POLL_INTERVAL)
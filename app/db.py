@@ -1,17 +1,43 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Dict, Iterable
 
+import os
 import uuid
 from fastapi import Depends
 from fastapi_users.models import ID
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID, SQLAlchemyUserDatabase
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import DeclarativeBase, relationship
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, UUID, JSON, DateTime
+from sqlalchemy.orm import DeclarativeBase, relationship, make_transient_to_detached
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, UUID, JSON, DateTime, Index, event, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from datetime import datetime, UTC
 
 from pydantic import BaseModel, Json
 
-DATABASE_URL = "sqlite+aiosqlite:///./data/test.db"
+from cache import LRUCache
+
+# sqlite+aiosqlite:///... for a single container, postgresql+asyncpg://... to scale out
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///./data/test.db")
+
+# SQLite tuning, applied to every new connection
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000")) # ms
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(1024 * 1024 * 256))) # 256MB
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", str(1024 * 64))) # KB
+
+# Postgres connection pool
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "500"))
+
+# authenticated users, the ttl bounds how long another worker's change can go unnoticed
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "60")) # seconds
+
+# attachment read grants, the ttl bounds how long a grant the sweeper removed lives on in other workers
+ATTACHMENT_ACCESS_CACHE_SIZE = int(os.environ.get("ATTACHMENT_ACCESS_CACHE_SIZE", "10000"))
+ATTACHMENT_ACCESS_CACHE_TTL = float(os.environ.get("ATTACHMENT_ACCESS_CACHE_TTL", "300")) # seconds
 
 
 class Base(DeclarativeBase):
@@ -51,6 +77,11 @@ class ApplicationAssignment(Base):
     user = relationship("User", back_populates="application_assignments")
     applications = relationship("Applications", back_populates="application_assignments")
 
+    # the primary key covers lookups by user, this one the reverse
+    __table_args__ = (
+        Index("ix_application_assignments_application_id", "application_id"),
+    )
+
 class ApplicationAssignmentCreate(BaseModel):
     user_id: uuid.UUID
     application_id: int
@@ -69,6 +100,15 @@ class Submission(Base):
     user = relationship("User", back_populates="submissions")
     applications = relationship("Applications", back_populates="submissions")
 
+    # a user's submissions, optionally for one application, newest first. id breaks ties between
+    # equal timestamps so the keyset pagination never needs a sort
+    __table_args__ = (
+        Index("ix_submissions_user_application_keyset", "user_id", "application_id", created_at.desc(), id.desc()),
+        Index("ix_submissions_user_keyset", "user_id", created_at.desc(), id.desc()),
+        # every submission of an application in id order, for exports
+        Index("ix_submissions_application_id", "application_id", "id"),
+    )
+
 class SubmissionCreate(BaseModel):
     application_id: int
     submission: str
@@ -83,15 +123,120 @@ class Attachment(Base):
     desc = Column(String, nullable=False)
 
     user = relationship("User", back_populates="attachments")
+    refs = relationship("AttachmentRef", back_populates="attachment")
+
+    __table_args__ = (
+        Index("ix_attachments_user_id", "user_id"),
+    )
+
+class AttachmentRef(Base):
+    # attachments are content addressed and shared, this is who may see a blob and how many
+    # of their submissions point at it
+    __tablename__ = "attachment_refs"
+
+    attachment_id = Column(UUID, ForeignKey("attachments.id"), primary_key=True)
+    user_id = Column(UUID, ForeignKey("user.id"), primary_key=True)
+    desc = Column(String, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    attachment = relationship("Attachment", back_populates="refs")
+
+    __table_args__ = (
+        Index("ix_attachment_refs_user_id", "user_id"),
+        # only the refs the sweeper looks for, uploads no submission points at
+        Index("ix_attachment_refs_unreferenced", "created_at", sqlite_where=text("ref_count = 0"), postgresql_where=text("ref_count = 0")),
+    )
+
+
+class LeaderboardEntry(Base):
+    # maintained incrementally in the same transaction as every submission write
+    __tablename__ = "leaderboard_entries"
+
+    application_id = Column(Integer, ForeignKey("applications.id"), primary_key=True)
+    user_id = Column(UUID, ForeignKey("user.id"), primary_key=True)
+    submission_count = Column(Integer, nullable=False, default=0)
+    latest_submission_at = Column(DateTime, nullable=True)
+    score = Column(Integer, nullable=False, default=0)
+
+    # an application's board in rank order, so reading the top N touches N index entries
+    __table_args__ = (
+        Index("ix_leaderboard_entries_rank", "application_id", score.desc(), submission_count.desc(), "latest_submission_at"),
+    )
+
+class LeaderboardScore(BaseModel):
+    score: int
 
+class DataVersion(Base):
+    # counters bumped by writers so in-process caches in every worker can tell they are stale
+    __tablename__ = "data_versions"
 
-engine = create_async_engine(DATABASE_URL)
+    key = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers carry on while a submission burst is writing, NORMAL sync is safe under WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def create_engine(url: str):
+    if url.startswith("sqlite"):
+        engine = create_async_engine(url, connect_args={"timeout": SQLITE_BUSY_TIMEOUT / 1000})
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+        return engine
+    if url.startswith("postgresql"):
+        return create_async_engine(
+            url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+            connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+        )
+    raise ValueError(f"Unsupported DATABASE_URL {url!r}, use sqlite+aiosqlite:// or postgresql+asyncpg://")
+
+
+engine = create_engine(DATABASE_URL)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
-async def create_db_and_tables():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+def dialect_insert(model):
+    # INSERT with ON CONFLICT support for the configured database
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+
+def attachment_ids(attachments) -> set:
+    # Submission.attachments is free-form JSON, normally a list of attachment uuid strings
+    if not isinstance(attachments, list):
+        return set()
+    ids = set()
+    for attachment in attachments:
+        try:
+            ids.add(uuid.UUID(str(attachment)))
+        except ValueError:
+            continue
+    return ids
+
+
+async def user_emails(session: AsyncSession, user_ids: Iterable) -> Dict:
+    # User.id is stored in a different format than the other tables' uuid columns on SQLite,
+    # so emails are looked up by id rather than joined onto submissions or scores
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return {}
+    result = await session.execute(select(User.id, User.email).where(User.id.in_(user_ids)))
+    return dict(result.all())
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
@@ -99,9 +244,47 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+# user id -> column values of an active user
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# (user id, attachment id) -> mime type of attachments the user may read
+attachment_access_cache = LRUCache(maxsize=ATTACHMENT_ACCESS_CACHE_SIZE, ttl=ATTACHMENT_ACCESS_CACHE_TTL)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_cached_user(mapper, connection, target):
+    # any flushed change to a user, is_active and is_superuser included, drops the cached copy
+    user_cache.pop(target.id)
+
+
+class CachedUserDatabase(SQLAlchemyUserDatabase):
+    # every authenticated request resolves its user by id; serve that from user_cache. each hit
+    # gets its own detached instance, so callers can still add it to their session and update it
+
+    async def get(self, id: ID):
+        values = user_cache.get(id)
+        if values is not None:
+            user = self.user_table(**values)
+            make_transient_to_detached(user)
+            return user
+        user = await super().get(id)
+        if user is not None and user.is_active:
+            user_cache.set(id, {column.key: getattr(user, column.key) for column in self.user_table.__mapper__.column_attrs})
+        return user
+
+    async def update(self, user, update_dict):
+        user_cache.pop(user.id)
+        return await super().update(user, update_dict)
+
+    async def delete(self, user):
+        user_cache.pop(user.id)
+        await super().delete(user)
+
+
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
-    yield SQLAlchemyUserDatabase(session, User) 
+    yield CachedUserDatabase(session, User)
 
 async def get_user_db_manual():
     async with async_session_maker() as session:
-        yield SQLAlchemyUserDatabase(session, User)
\ No newline at end of file
+        yield CachedUserDatabase(session, User)
\ No newline at end of file
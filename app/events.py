@@ -0,0 +1,194 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Set
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+
+from db import User
+from storage import DATA_DIR
+from users import current_active_user
+
+# memory: events stay inside this worker. file: workers share events through an append-only
+# log on the data volume, a stand-in for a real broker when running several workers
+EVENT_BROKER = os.environ.get("EVENT_BROKER", "memory")
+EVENT_LOG = os.environ.get("EVENT_LOG", os.path.join(DATA_DIR, "events.log"))
+EVENT_LOG_MAX_BYTES = int(os.environ.get("EVENT_LOG_MAX_BYTES", str(1024 * 1024 * 8))) # 8MB
+EVENT_POLL_INTERVAL = float(os.environ.get("EVENT_POLL_INTERVAL", "0.25"))
+SUBSCRIBER_QUEUE_SIZE = 100
+KEEPALIVE_INTERVAL = 15
+
+router = APIRouter(tags=["events"])
+
+
+def json_default(value):
+    # datetimes the way the JSON API renders them, everything else (uuids) as strings
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class MemoryBroker:
+
+    def __init__(self):
+        # queue -> id of the user it streams to
+        self._subscribers: Dict[asyncio.Queue, str] = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: dict):
+        self.deliver(event)
+
+    def deliver(self, event: dict):
+        # only into the queues of the users the event is for: a stalled client's queue fills up
+        # with its own events, not everyone else's
+        audience = recipients(event)
+        for queue, user_id in list(self._subscribers.items()):
+            if audience is not None and user_id not in audience:
+                continue
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # a stalled client misses events rather than making us hold them
+                pass
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: str):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[queue] = user_id
+        try:
+            yield queue
+        finally:
+            self._subscribers.pop(queue, None)
+
+
+class FileBroker(MemoryBroker):
+    # every worker appends events to the log and tails it, delivering what it reads to its own
+    # subscribers. the log is rotated once it grows past max_bytes, like tail -F readers follow
+    # the new file after draining the old one
+
+    def __init__(self, path: str, max_bytes: int, poll_interval: float):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # only events published from now on are interesting
+        open(self.path, "ab").close()
+        reader = open(self.path, "rb")
+        reader.seek(0, os.SEEK_END)
+        self._task = asyncio.create_task(self._tail(reader))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def publish(self, event: dict):
+        # a single O_APPEND write keeps lines from concurrent workers from interleaving
+        line = (json.dumps(event, default=json_default) + "\n").encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            if os.fstat(fd).st_size > self.max_bytes:
+                os.replace(self.path, f"{self.path}.1")
+        finally:
+            os.close(fd)
+
+    def _read(self, reader, buffer: bytes) -> bytes:
+        # deliver every complete line, returns the incomplete rest
+        data = reader.read()
+        if not data:
+            return buffer
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            if line:
+                self.deliver(json.loads(line))
+        return buffer
+
+    async def _tail(self, reader):
+        buffer = b""
+        try:
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                buffer = self._read(reader, buffer)
+                # rotated: drain what was appended to the old file before switching to the new one
+                try:
+                    rotated = os.stat(self.path).st_ino != os.fstat(reader.fileno()).st_ino
+                except FileNotFoundError:
+                    continue
+                if rotated:
+                    self._read(reader, buffer)
+                    reader.close()
+                    reader = open(self.path, "rb")
+                    buffer = b""
+        finally:
+            reader.close()
+
+
+def create_broker():
+    if EVENT_BROKER == "file":
+        return FileBroker(EVENT_LOG, EVENT_LOG_MAX_BYTES, EVENT_POLL_INTERVAL)
+    if EVENT_BROKER == "memory":
+        return MemoryBroker()
+    raise ValueError(f"Unsupported EVENT_BROKER {EVENT_BROKER!r}, use memory or file")
+
+
+broker = create_broker()
+
+
+async def publish(event_type: str, user_id=None, user_ids: Optional[Iterable] = None, **data):
+    # events with a user_id only go to that user, with user_ids only to those users, the rest to
+    # everyone. called after the commit, a lost event must not turn a successful write into an error
+    event = {"type": event_type, "user_id": str(user_id) if user_id else None, **data}
+    if user_ids is not None:
+        event["user_ids"] = [str(uid) for uid in user_ids]
+    try:
+        await broker.publish(event)
+    except Exception as e:
+        print(f"Could not publish {event_type} event: {e!r}")
+
+
+def recipients(event: dict) -> Optional[Set[str]]:
+    # the ids of the users an event is for, None if it is for everyone
+    if "user_ids" in event:
+        return set(event["user_ids"])
+    if event.get("user_id"):
+        return {event["user_id"]}
+    return None
+
+
+def format_event(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=json_default)}\n\n"
+
+
+@router.get("/events")
+async def events(request: Request, user: User = Depends(current_active_user)):
+    user_id = str(user.id)
+
+    async def stream():
+        async with broker.subscribe(user_id) as queue:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # comment line, keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_event(event)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
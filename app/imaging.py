@@ -0,0 +1,165 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+import magic
+from PIL import Image, ImageOps
+
+from metrics import upload_stage_duration
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+THUMBNAIL_TIMEOUT = float(os.environ.get("THUMBNAIL_TIMEOUT", "5"))
+THUMBNAIL_SIZE = (128, 128)
+
+# a small, highly compressed file can still decode to an enormous bitmap
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(40_000_000))) # 40MP
+MAX_DECODE_BYTES = int(os.environ.get("MAX_DECODE_BYTES", str(1024 * 1024 * 256))) # 256MB
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pending: Dict[str, asyncio.Future] = {}
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def start_pool():
+    global _pool
+    if _pool is None:
+        # spawn keeps the workers clean of the event loop and sqlite threads of the parent
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def restart_pool(broken: ProcessPoolExecutor):
+    # a worker that died (e.g. OOM killed) breaks the whole pool. every job on it fails at once,
+    # only the first to get here replaces it
+    global _pool
+    if _pool is broken:
+        print("Image worker pool broke, starting a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        start_pool()
+
+
+async def run_in_pool(fn, *args):
+    # falls back to the default thread pool when the process pool isn't running (e.g. from a CLI)
+    loop = asyncio.get_running_loop()
+    pool = _pool
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        if pool is None:
+            raise
+        # once: a job that kills its worker every time fails the second time too
+        restart_pool(pool)
+        return await loop.run_in_executor(_pool, fn, *args)
+
+
+# make_thumbnail runs inside the worker processes. sniff_mime and check_image only read a header,
+# uploads call them in a thread so they never queue behind the thumbnail jobs
+
+def sniff_mime(header: bytes) -> str:
+    return magic.from_buffer(header, mime=True)
+
+
+def _open_within_budget(src: str, width: Optional[int] = None) -> Image.Image:
+    # Image.open only parses the header, nothing is decoded until load(). Pillow refuses headers
+    # past twice its own pixel limit by itself, with an error of its own
+    try:
+        image = Image.open(src)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from e
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"Image is {image.width}x{image.height}, max is {MAX_IMAGE_PIXELS} pixels")
+
+    # JPEG can decode straight to a 1/2, 1/4 or 1/8 scale, still at least width pixels wide
+    if width is not None and image.format == "JPEG":
+        image.draft("RGB", (width, width))
+
+    if image.width * image.height * len(image.getbands()) > MAX_DECODE_BYTES:
+        raise ImageTooLarge(f"Decoding a {image.width}x{image.height} {image.mode} image needs more than {MAX_DECODE_BYTES} bytes")
+    return image
+
+
+def check_image(src: str):
+    with _open_within_budget(src):
+        pass
+
+
+def make_thumbnail(src: str, dst: str, width: int = THUMBNAIL_SIZE[0], fmt: str = "JPEG"):
+    image = _open_within_budget(src, width)
+    image = ImageOps.exif_transpose(image)  # apply the EXIF orientation before it is dropped below
+    image.thumbnail((width, width))  # Resize the image so that the largest dimension is width pixels
+
+    # Convert the image to RGB mode if it's not
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    # strip EXIF/XMP and the like, only the colour profile is worth keeping
+    icc_profile = image.info.get("icc_profile")
+    image.info = {"icc_profile": icc_profile} if icc_profile else {}
+
+    # write next to the destination and rename so readers never see a partial thumbnail
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        image.save(tmp, fmt, **image.info)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+async def render_thumbnail(src: str, dst: str, width: int, fmt: str, store: bool):
+    # imported here, the worker processes load this module and have no use for the storage
+    from storage import storage, staged
+
+    # the original is read from a local copy (the file itself for local storage)
+    async with storage.local_copy(src) as path:
+        if store:
+            async with staged(dst) as tmp_path:
+                await run_in_pool(make_thumbnail, path, tmp_path, width, fmt)
+        else:
+            await run_in_pool(make_thumbnail, path, dst, width, fmt)
+
+
+def schedule_thumbnail(src: str, dst: str, width: int = THUMBNAIL_SIZE[0], fmt: str = "JPEG", store: bool = True) -> asyncio.Future:
+    # src is the storage key of the original. dst is a storage key, or a local path with store=False.
+    # one job per thumbnail, concurrent callers share it
+    future = _pending.get(dst)
+    if future is None:
+        started = time.perf_counter()
+        future = asyncio.ensure_future(render_thumbnail(src, dst, width, fmt, store))
+        _pending[dst] = future
+
+        def done(f: asyncio.Future):
+            _pending.pop(dst, None)
+            # queueing for a worker included, it is part of how long the thumbnail takes to appear
+            upload_stage_duration.observe(time.perf_counter() - started, "thumbnail")
+            if not f.cancelled() and f.exception() is not None:
+                print(f"Thumbnail generation for {src} failed: {f.exception()!r}")
+
+        future.add_done_callback(done)
+    return future
+
+
+async def ensure_thumbnail(src: str, dst: str, width: int = THUMBNAIL_SIZE[0], fmt: str = "JPEG", store: bool = True) -> bool:
+    # for a thumbnail the caller found missing: wait for a pending one, generating it on demand if
+    # nothing is queued (e.g. after a restart). returns False if it isn't ready within
+    # THUMBNAIL_TIMEOUT or generation failed
+    try:
+        await asyncio.wait_for(asyncio.shield(schedule_thumbnail(src, dst, width, fmt, store)), THUMBNAIL_TIMEOUT)
+    except Exception:
+        return False
+    return True
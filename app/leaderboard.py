@@ -0,0 +1,161 @@
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import User, ApplicationAssignment, Submission, LeaderboardEntry, LeaderboardScore, DataVersion, async_session_maker, dialect_insert, user_emails
+from users import current_active_user
+import versions
+
+# the most rows a board returns, and so the most each cached board holds
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", "100"))
+
+router = APIRouter(tags=["leaderboard"])
+
+# application id (None for the overall board) -> (version, ranked rows)
+_boards: Dict[Optional[int], Tuple[int, List[dict]]] = {}
+
+
+def version_key(application_id: int) -> str:
+    return f"leaderboard:{application_id}"
+
+
+async def overall_version(session: AsyncSession) -> int:
+    # the overall board has no version row of its own, every submission would update that one row
+    # and queue behind the others on it. the per-application versions only ever go up, so their
+    # sum changes whenever any board does. ";" sorts right after ":", keeping this a key range scan
+    result = await session.execute(
+        select(func.coalesce(func.sum(DataVersion.version), 0)).
+        where(DataVersion.key > "leaderboard:", DataVersion.key < "leaderboard;"))
+    return result.scalar()
+
+
+async def record_submission(session: AsyncSession, submission: Submission):
+    # call after the submission is flushed, inside the same transaction
+    stmt = dialect_insert(LeaderboardEntry).values(
+        application_id=submission.application_id,
+        user_id=submission.user_id,
+        submission_count=1,
+        latest_submission_at=submission.created_at,
+        score=0)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[LeaderboardEntry.application_id, LeaderboardEntry.user_id],
+        set_={
+            "submission_count": LeaderboardEntry.submission_count + 1,
+            "latest_submission_at": stmt.excluded.latest_submission_at,
+        }))
+    await versions.bump(session, version_key(submission.application_id))
+
+
+async def remove_submission(session: AsyncSession, submission: Submission):
+    # call after the delete is flushed; the new latest timestamp is one index lookup
+    latest = (
+        select(func.max(Submission.created_at)).
+        where(Submission.user_id == submission.user_id, Submission.application_id == submission.application_id).
+        scalar_subquery()
+    )
+    await session.execute(
+        update(LeaderboardEntry).
+        where(LeaderboardEntry.application_id == submission.application_id, LeaderboardEntry.user_id == submission.user_id).
+        values(submission_count=LeaderboardEntry.submission_count - 1, latest_submission_at=latest))
+    await versions.bump(session, version_key(submission.application_id))
+
+
+def rank_order(score, submission_count, latest_submission_at):
+    # highest score first, then most submissions, then whoever got there first
+    return (score.desc(), submission_count.desc(), latest_submission_at)
+
+
+async def load_board(session: AsyncSession, application_id: Optional[int]) -> List[dict]:
+    if application_id is not None:
+        query = (
+            select(LeaderboardEntry.user_id, LeaderboardEntry.score, LeaderboardEntry.submission_count, LeaderboardEntry.latest_submission_at).
+            where(LeaderboardEntry.application_id == application_id, LeaderboardEntry.submission_count > 0).
+            order_by(*rank_order(LeaderboardEntry.score, LeaderboardEntry.submission_count, LeaderboardEntry.latest_submission_at)).
+            limit(LEADERBOARD_SIZE)
+        )
+    else:
+        # per user totals across applications, grouped over the entries not the submissions
+        score = func.sum(LeaderboardEntry.score).label("score")
+        submission_count = func.sum(LeaderboardEntry.submission_count).label("submission_count")
+        latest_submission_at = func.max(LeaderboardEntry.latest_submission_at).label("latest_submission_at")
+        query = (
+            select(LeaderboardEntry.user_id, score, submission_count, latest_submission_at).
+            where(LeaderboardEntry.submission_count > 0).
+            group_by(LeaderboardEntry.user_id).
+            order_by(*rank_order(score, submission_count, latest_submission_at)).
+            limit(LEADERBOARD_SIZE)
+        )
+    rows = (await session.execute(query)).all()
+
+    emails = await user_emails(session, (row.user_id for row in rows))
+    return [
+        {"rank": rank, "email": emails.get(row.user_id), **row._mapping}
+        for rank, row in enumerate(rows, start=1)
+    ]
+
+
+async def get_board(session: AsyncSession, application_id: Optional[int], limit: int) -> List[dict]:
+    # the version check is a primary key lookup; the board itself is only rebuilt after a write
+    if application_id is None:
+        version = await overall_version(session)
+    else:
+        version = (await versions.current(session, version_key(application_id)))[version_key(application_id)]
+    cached = _boards.get(application_id)
+    if cached is None or cached[0] != version:
+        cached = (version, await load_board(session, application_id))
+        _boards[application_id] = cached
+    return cached[1][:limit]
+
+
+async def check_board_access(session: AsyncSession, application_id: int, user: User, admin: bool = False):
+    if user.is_superuser:
+        return
+    result = await session.execute(
+        select(ApplicationAssignment.is_admin).
+        where(ApplicationAssignment.application_id == application_id, ApplicationAssignment.user_id == user.id))
+    is_admin = result.scalar()
+    if is_admin is None or (admin and not is_admin):
+        raise HTTPException(status_code=403, detail="User does not have access to this application")
+
+
+def check_board_limit(limit: int):
+    if limit < 1 or limit > LEADERBOARD_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {LEADERBOARD_SIZE}")
+
+
+@router.get("/applications/{application_id}/leaderboard")
+async def get_application_leaderboard(application_id: int, limit: int = 10, user: User = Depends(current_active_user)):
+    check_board_limit(limit)
+    async with async_session_maker() as session:
+        await check_board_access(session, application_id, user)
+        return {"application_id": application_id, "leaderboard": await get_board(session, application_id, limit)}
+
+
+@router.get("/leaderboard")
+async def get_leaderboard(limit: int = 10, user: User = Depends(current_active_user)):
+    # every participant's email and totals across all applications, for superusers only
+    if not user.is_superuser:
+        raise HTTPException(status_code=403, detail="User is not superuser")
+    check_board_limit(limit)
+    async with async_session_maker() as session:
+        return {"leaderboard": await get_board(session, None, limit)}
+
+
+@router.put("/applications/{application_id}/leaderboard/{user_id}")
+async def set_leaderboard_score(application_id: int, user_id: uuid.UUID, score: LeaderboardScore, user: User = Depends(current_active_user)):
+    # superusers and the application's admins grade submissions
+    async with async_session_maker() as session:
+        await check_board_access(session, application_id, user, admin=True)
+        result = await session.execute(
+            update(LeaderboardEntry).
+            where(LeaderboardEntry.application_id == application_id, LeaderboardEntry.user_id == user_id).
+            values(score=score.score))
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail="User has no submissions for this application")
+        await versions.bump(session, version_key(application_id))
+        await session.commit()
+    return {"message": "Score updated successfully", "application_id": application_id, "user_id": user_id, "score": score.score}
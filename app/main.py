@@ -1,12 +1,10 @@
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request, Depends, HTTPException, UploadFile, Form
+from fastapi import FastAPI, Request, Depends, HTTPException
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, RedirectResponse, Response
 
-import magic
-
 from typing import List, Optional
 
 from db import (
@@ -18,34 +16,81 @@ from db import (
     Submission, 
     SubmissionCreate, 
     Attachment,
-    create_db_and_tables, 
-    async_session_maker
+    AttachmentRef,
+    attachment_ids,
+    dialect_insert,
+    async_session_maker,
+    engine,
+    user_cache,
+    attachment_access_cache
 )
-from sqlalchemy import select
-from schemas import UserCreate, UserRead, UserUpdate
+from sqlalchemy import select, update, func, and_, tuple_
+from datetime import datetime
+from schemas import UserCreate, UserRead, UserUpdate, ApplicationPage, ApplicationAssignmentList, SubmissionPage, Dashboard, AttachmentUploadFields, SubmissionUploadFields
 import uuid
-import hashlib
 from users import cookie_auth_backend, api_auth_backend, current_active_user, current_active_user_optional, fastapi_users
-from saml import router as saml_router
-
-from PIL import Image
-import io
+from saml import router as saml_router, load_saml_settings
+from leaderboard import router as leaderboard_router, record_submission, remove_submission
+from events import router as events_router, broker, publish
+from admin import router as admin_router
+from search import router as search_router
+from admission import AdmissionMiddleware, upload_admission, submission_admission
+from catalog import catalog, application_summary
+from metrics import MetricsMiddleware, instrument_engine, register_cache, render as render_metrics, token_allowed
+from migrations import migrate, RUN_MIGRATIONS_ON_STARTUP
+from pagination import DEFAULT_PAGE_SIZE, check_limit, encode_cursor, decode_created_at_cursor, decode_id_cursor, parse_fields
+from uploads import receive_upload_form, form_openapi, discard_new_blobs, store_swept_blobs, IngestedFile
+from storage import storage, original_key, thumbnail_key
+from sweeper import run_sweeper, SWEEPER_ENABLED
+from cache import etag_matches
+from imaging import start_pool, shutdown_pool, schedule_thumbnail, ensure_thumbnail, THUMBNAIL_SIZE
+from variants import variant_cache, negotiate_format, VARIANT_WIDTHS, VARIANT_FORMATS
+import versions
+
+import asyncio
 import os
 
-MAX_UPLOAD_SIZE = 1024 * 1024 * 4 # 4MB
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Not needed if you setup a migration system like Alembic
-    await create_db_and_tables()
+    if RUN_MIGRATIONS_ON_STARTUP:
+        await migrate()
+    await catalog.load()
+    load_saml_settings()
+    start_pool()
+    variant_cache.load()
+    await broker.start()
+    sweeper = asyncio.create_task(run_sweeper()) if SWEEPER_ENABLED else None
     yield
+    if sweeper is not None:
+        sweeper.cancel()
+    await broker.stop()
+    shutdown_pool()
 
 app = FastAPI(lifespan=lifespan)
+# the last middleware added runs first: metrics see the requests admission turns away
+app.add_middleware(AdmissionMiddleware, routes={
+    ("POST", "/upload_attachment"): upload_admission,
+    ("POST", "/application_submission/multipart"): upload_admission,
+    ("POST", "/application_submission"): submission_admission,
+})
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
+PENDING_THUMBNAIL = "static/thumbnail-pending.svg"
+ATTACHMENT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+SUBMISSION_FIELDS = ["id", "application_id", "user_id", "submission", "attachments", "created_at"]
+
+# the newest submissions the dashboard includes per application, older ones are paged in
+DASHBOARD_SUBMISSIONS = int(os.environ.get("DASHBOARD_SUBMISSIONS", str(DEFAULT_PAGE_SIZE)))
+
+register_cache("attachment_access", attachment_access_cache)
+register_cache("user", user_cache)
+
 app.include_router(
     fastapi_users.get_auth_router(api_auth_backend), prefix="/auth/jwt-api", tags=["auth"]
 )
@@ -74,6 +119,10 @@ app.include_router(
 )
 
 app.include_router(saml_router)
+app.include_router(leaderboard_router)
+app.include_router(events_router)
+app.include_router(admin_router)
+app.include_router(search_router)
 
 #api to create a new application
 @app.post("/applications")
@@ -91,12 +140,14 @@ async def create_application(application: ApplicationCreate, user: User = Depend
         try:
             # add the new application to the session
             session.add(new_application)
+            await versions.bump(session, versions.CATALOG)
 
             # commit the transaction
             await session.commit()
 
             # refresh the instance in case any attributes have been modified on the server side
             await session.refresh(new_application)
+            catalog.put(application_summary(new_application))
 
             return {"message": "Application created successfully", "application": new_application.id}
         except Exception as e:
@@ -123,45 +174,109 @@ async def update_application(application_id: int, application_update: Applicatio
         application.is_active = application_update.is_active
         application.description = application_update.description
         application.instructions = application_update.instructions
+        await versions.bump(session, versions.CATALOG)
         # commit the transaction
         await session.commit()
+        catalog.put(application_summary(application))
 
+        # name, description and instructions are only for the users assigned to it
+        result = await session.execute(select(ApplicationAssignment.user_id).where(ApplicationAssignment.application_id == application_id))
+        await publish("application-updated", user_ids=result.scalars().all(), application=application_summary(application))
         return {"message": "Application updated successfully", "application": application.id}
 
-@app.get("/applications")
-async def get_applications(user: User = Depends(current_active_user)):
+@app.get("/applications", response_model=ApplicationPage)
+async def get_applications(limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, user: User = Depends(current_active_user)):
     if not user.is_superuser:
         raise HTTPException(status_code=403, detail="User is not superuser")
-    # fetch all applications
-    async with async_session_maker() as session:
-        result = await session.execute(select(Applications))
-        applications = result.scalars().all()
-        return {"applications": applications}
-
-@app.get("/applications/me")
+    check_limit(limit)
+    # a page of applications from the catalog, one extra row tells us whether there is another page
+    after = decode_id_cursor(cursor) if cursor is not None else None
+    applications = await catalog.page(after, limit + 1)
+    next_cursor = encode_cursor(applications[limit - 1]["id"]) if len(applications) > limit else None
+    return {"applications": applications[:limit], "next_cursor": next_cursor}
+
+@app.get("/applications/me", response_model=ApplicationAssignmentList)
 async def get_applications(user: User = Depends(current_active_user)):
-    # fetch all assigned applications
+    # fetch all assigned applications: the assignments from the database, the applications from the catalog
     async with async_session_maker() as session:
         # query the ApplicationAssignment table
         result = await session.execute(
-            select(ApplicationAssignment, Applications).
-            join(Applications, ApplicationAssignment.application_id == Applications.id).
+            select(ApplicationAssignment.application_id, ApplicationAssignment.is_admin).
             where(ApplicationAssignment.user_id == user.id))
         rows = result.all()
-        assignments = [
-            {
-                "user_id": assignment.user_id,
-                "application_id": assignment.application_id,
-                "is_admin": assignment.is_admin,
-                "application": {
-                    "name": application.name,
-                    "id": application.id,
-                    "description": application.description,
-                    "instructions": application.instructions
+    applications = await catalog.lookup([row.application_id for row in rows])
+    assignments = [
+        {
+            "user_id": user.id,
+            "application_id": row.application_id,
+            "is_admin": row.is_admin,
+            "application": applications[row.application_id]
+        } for row in rows if row.application_id in applications
+    ]
+    return {"application_assignments": assignments}
+
+@app.get("/dashboard", response_model=Dashboard, response_model_exclude_unset=True)
+async def get_dashboard(request: Request, response: Response, user: User = Depends(current_active_user)):
+    # everything the page needs on load: assignments, their applications and each one's newest submissions
+    async with async_session_maker() as session:
+        # the versions are read before the data, so a concurrent write at worst costs one extra refetch
+        current = await versions.current(session, versions.user_key(user.id), versions.CATALOG)
+        etag = f'"{user.id.hex}-{current[versions.user_key(user.id)]}-{current[versions.CATALOG]}"'
+        headers = {"ETag": f"W/{etag}", "Cache-Control": "private, no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+
+        # one query: the user's submissions numbered newest first per application, joined onto the
+        # assignments. one row past the limit tells us whether there is another page
+        ranked = (
+            select(
+                Submission.id, Submission.application_id, Submission.submission, Submission.attachments, Submission.created_at,
+                func.row_number().over(
+                    partition_by=Submission.application_id,
+                    order_by=(Submission.created_at.desc(), Submission.id.desc())).label("position")).
+            where(Submission.user_id == user.id).
+            subquery()
+        )
+        result = await session.execute(
+            select(
+                ApplicationAssignment.application_id, ApplicationAssignment.is_admin,
+                Applications.name, Applications.description, Applications.instructions,
+                ranked.c.id, ranked.c.submission, ranked.c.attachments, ranked.c.created_at).
+            join(Applications, ApplicationAssignment.application_id == Applications.id).
+            outerjoin(ranked, and_(
+                ranked.c.application_id == ApplicationAssignment.application_id,
+                ranked.c.position <= DASHBOARD_SUBMISSIONS + 1)).
+            where(ApplicationAssignment.user_id == user.id).
+            order_by(ApplicationAssignment.application_id, ranked.c.position))
+
+        assignments = {}
+        for row in result:
+            assignment = assignments.get(row.application_id)
+            if assignment is None:
+                assignment = assignments[row.application_id] = {
+                    "user_id": user.id,
+                    "application_id": row.application_id,
+                    "is_admin": row.is_admin,
+                    "application": {
+                        "name": row.name,
+                        "id": row.application_id,
+                        "description": row.description,
+                        "instructions": row.instructions
+                    },
+                    "submissions": [],
+                    "next_cursor": None,
                 }
-            } for assignment, application in rows   
-        ]
-        return {"application_assignments": assignments}
+            if row.id is None:
+                continue
+            submissions = assignment["submissions"]
+            if len(submissions) == DASHBOARD_SUBMISSIONS:
+                last = submissions[-1]
+                assignment["next_cursor"] = encode_cursor(last["created_at"], last["id"])
+                continue
+            submissions.append({"id": row.id, "created_at": row.created_at, "submission": row.submission, "attachments": row.attachments})
+
+    return {"application_assignments": list(assignments.values())}
 
 @app.post("/application_assignments")
 async def assign_application(application_assignment: ApplicationAssignmentCreate, user: User = Depends(current_active_user)):
@@ -175,6 +290,7 @@ async def assign_application(application_assignment: ApplicationAssignmentCreate
 
             # add the new assignment to the session
             session.add(new_assignment)
+            await versions.bump(session, versions.user_key(application_assignment.user_id))
 
             # commit the transaction
             await session.commit()
@@ -189,15 +305,35 @@ async def assign_application(application_assignment: ApplicationAssignmentCreate
         finally:
             await session.close()
 
+def submission_summary(submission: Submission) -> dict:
+    return {field: getattr(submission, field) for field in SUBMISSION_FIELDS}
+
+async def publish_submission_created(submission: Submission):
+    await publish("submission-created", user_id=submission.user_id, submission=submission_summary(submission))
+
 @app.post("/application_submission")
 async def application_submission(submission: SubmissionCreate, user: User = Depends(current_active_user)):
+    referenced = attachment_ids(submission.attachments)
     async with async_session_maker() as session:
+        # only attachments the user uploaded themselves can be referenced. the increment is the
+        # check: a ref that never existed, or that the sweeper expired a moment ago, matches no row
+        if referenced:
+            result = await session.execute(
+                update(AttachmentRef).
+                where(AttachmentRef.user_id == user.id, AttachmentRef.attachment_id.in_(referenced)).
+                values(ref_count=AttachmentRef.ref_count + 1))
+            if result.rowcount != len(referenced):
+                await session.rollback()
+                raise HTTPException(status_code=403, detail="User does not have access to this attachment")
         try:
             # create a new Submission instance
             new_submission = Submission(application_id=submission.application_id, user_id=user.id, submission=submission.submission, attachments=submission.attachments)
 
             # add the new submission to the session
             session.add(new_submission)
+            await session.flush()
+            await record_submission(session, new_submission)
+            await versions.bump(session, versions.user_key(user.id))
 
             # commit the transaction
             await session.commit()
@@ -205,6 +341,7 @@ async def application_submission(submission: SubmissionCreate, user: User = Depe
             # refresh the instance in case any attributes have been modified on the server side
             await session.refresh(new_submission)
 
+            await publish_submission_created(new_submission)
             return {"message": "Submission created successfully", "submission_id": new_submission.id}
         except Exception as e:
             await session.rollback()
@@ -212,21 +349,42 @@ async def application_submission(submission: SubmissionCreate, user: User = Depe
         finally:
             await session.close()
 
-@app.get("/application_submission")
-async def get_application_submission(application_id: Optional[int] = None, user: User = Depends(current_active_user)):
+@app.get("/application_submission", response_model=SubmissionPage, response_model_exclude_unset=True)
+async def get_application_submission(
+        application_id: Optional[int] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        fields: Optional[str] = None,
+        user: User = Depends(current_active_user)
+    ):
+    check_limit(limit)
+    columns = parse_fields(fields, SUBMISSION_FIELDS, required=["id", "created_at"])
     async with async_session_maker() as session:
-        # Create a query that selects all submissions for the current user
-        query = select(Submission).where(Submission.user_id == user.id)
+        # Create a query that selects a page of the current user's submissions, newest first
+        query = (
+            select(*[getattr(Submission, column) for column in columns]).
+            where(Submission.user_id == user.id).
+            order_by(Submission.created_at.desc(), Submission.id.desc()).
+            limit(limit + 1)
+        )
 
         # If an application ID was provided, add a filter for it to the query
         if application_id is not None:
             query = query.where(Submission.application_id == application_id)
 
+        # Continue after the last submission of the previous page
+        if cursor is not None:
+            query = query.where(tuple_(Submission.created_at, Submission.id) < decode_created_at_cursor(cursor))
+
         # Execute the query
         result = await session.execute(query)
-        submissions = result.scalars().all()
+        submissions = [dict(row._mapping) for row in result]
 
-        return {"submissions": submissions}
+        next_cursor = None
+        if len(submissions) > limit:
+            last = submissions[limit - 1]
+            next_cursor = encode_cursor(last["created_at"], last["id"])
+        return {"submissions": submissions[:limit], "next_cursor": next_cursor}
 
 @app.delete("/application_submission/{submission_id}")
 async def delete_application_submission(submission_id: int, user: User = Depends(current_active_user)):
@@ -237,67 +395,121 @@ async def delete_application_submission(submission_id: int, user: User = Depends
             raise HTTPException(status_code=404, detail="Submission not found")
         if submission.user_id != user.id:
             raise HTTPException(status_code=403, detail="User does not have access to this submission")
+        referenced = attachment_ids(submission.attachments)
+        if referenced:
+            await session.execute(
+                update(AttachmentRef).
+                where(AttachmentRef.user_id == user.id, AttachmentRef.attachment_id.in_(referenced), AttachmentRef.ref_count > 0).
+                values(ref_count=AttachmentRef.ref_count - 1))
         await session.delete(submission)
+        await session.flush()
+        await remove_submission(session, submission)
+        await versions.bump(session, versions.user_key(user.id))
         await session.commit()
+    await publish("submission-deleted", user_id=user.id, submission_id=submission.id, application_id=submission.application_id)
     return {"message": "Submission deleted successfully"}
 
-@app.post("/upload_attachment")
-async def upload_attachment(fileAttach: List[UploadFile] = Form(...), desc: str = Form(...), user: User = Depends(current_active_user)):
-    uuids = []
-    for attachment in fileAttach:
-        if attachment.filename == "":
-            continue
-        attachment_file = await attachment.read()
-
-        if len(attachment_file) > MAX_UPLOAD_SIZE:
-            raise HTTPException(status_code=400, detail=f"File size too large. Max file size is {MAX_UPLOAD_SIZE} bytes")
-
-        mime_type = magic.from_buffer(attachment_file, mime=True)
-
-        if mime_type not in ["image/jpeg", "image/png"]:
-            raise HTTPException(status_code=400, detail="Only image/jpeg and image/png are allowed")
-
-        file_hash = hashlib.sha256(attachment_file).hexdigest()
-        file_uuid = uuid.UUID(file_hash[:32])
-
-        with open(f"data/{file_uuid}.{mime_type.split('/')[-1]}", "wb") as f:
-            f.write(attachment_file)
-
-        # Open the image and create a thumbnail
-        image = Image.open(io.BytesIO(attachment_file))
-        image.thumbnail((128, 128))  # Resize the image so that the largest dimension is 128 pixels
-
-        # Convert the image to RGB mode if it's not
-        if image.mode in ("RGBA", "P"):
-            image = image.convert("RGB")
-
-        # Save the thumbnail
-        thumbnail_path = f"data/{file_uuid}_thumbnail.jpg"
-        image.save(thumbnail_path, "JPEG")
+async def add_attachments(session, ingested: List[IngestedFile], user: User, desc: str, referenced: bool):
+    # one multi-row INSERT per table for the whole batch. the blob row is shared by everyone who
+    # uploads the same content, the ref row is what grants this user access to it
+    files = list({file.id: file for file in ingested}.values())
+    if not files:
+        return
+    # an update rather than do-nothing on conflict, so the row is locked: a sweep removing the blob
+    # finishes first and the insert brings the row back, see store_swept_blobs
+    stmt = dialect_insert(Attachment).values([{"id": file.id, "mime_type": file.mime_type, "user_id": user.id, "desc": desc} for file in files])
+    await session.execute(stmt.on_conflict_do_update(index_elements=[Attachment.id], set_={"mime_type": stmt.excluded.mime_type}))
+    ref_count = 1 if referenced else 0
+    now = datetime.utcnow()
+    stmt = dialect_insert(AttachmentRef).values([
+        {"attachment_id": file.id, "user_id": user.id, "desc": desc, "ref_count": ref_count, "created_at": now} for file in files
+    ])
+    # uploading again restarts the grace period the sweeper gives unreferenced uploads
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[AttachmentRef.attachment_id, AttachmentRef.user_id],
+        set_={"ref_count": AttachmentRef.ref_count + ref_count, "created_at": now}))
+
+def schedule_thumbnails(ingested: List[IngestedFile]):
+    # the originals are durable at this point, the thumbnails are built in the background.
+    # a blob we already had has its thumbnail already (or gets one on first request)
+    for file in ingested:
+        if file.created:
+            schedule_thumbnail(file.key, thumbnail_key(file.id))
+
+@app.post("/upload_attachment", openapi_extra=form_openapi(AttachmentUploadFields))
+async def upload_attachment(request: Request, user: User = Depends(current_active_user)):
+    form = await receive_upload_form(request, AttachmentUploadFields, require_files=True)
+    ingested, desc = form.files, form.fields.desc
+    async with async_session_maker() as session:
+        try:
+            await add_attachments(session, ingested, user, desc, referenced=False)
 
-        async with async_session_maker() as session:
-            try:
-                # create a new Attachment instance
-                new_attachment = Attachment(mime_type=mime_type, user_id=user.id, desc=desc, id=file_uuid)
+            # commit the transaction
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            await discard_new_blobs(ingested)
+            raise HTTPException(status_code=400, detail="Could not create attachment") from e
+        finally:
+            await session.close()
+    await store_swept_blobs(ingested)
+    schedule_thumbnails(ingested)
+    return {"message": "Attachment uploaded successfully", "uuids": [file.id for file in ingested]}
+
+@app.post("/application_submission/multipart", openapi_extra=form_openapi(SubmissionUploadFields))
+async def application_submission_multipart(request: Request, user: User = Depends(current_active_user)):
+    # text and files in one request: the attachments and the submission commit together or not at all
+    form = await receive_upload_form(request, SubmissionUploadFields)
+    ingested, desc = form.files, form.fields.desc
+    application_id, submission = form.fields.application_id, form.fields.submission
+    async with async_session_maker() as session:
+        try:
+            await add_attachments(session, ingested, user, desc, referenced=True)
 
-                # add the new attachment to the session
-                session.add(new_attachment)
+            # create a new Submission instance
+            new_submission = Submission(application_id=application_id, user_id=user.id, submission=submission, attachments=list(dict.fromkeys(str(file.id) for file in ingested)))
 
-                # commit the transaction
-                await session.commit()
+            # add the new submission to the session
+            session.add(new_submission)
+            await session.flush()
+            await record_submission(session, new_submission)
+            await versions.bump(session, versions.user_key(user.id))
 
-                # refresh the instance in case any attributes have been modified on the server side
-                await session.refresh(new_attachment)
-            except Exception as e:
-                await session.rollback()
-                raise HTTPException(status_code=400, detail="Could not create attachment") from e
-            finally:
-                await session.close()
-        uuids.append(file_uuid)
-    return {"message": "Attachment uploaded successfully", "uuids": uuids}
+            # commit the transaction
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            await discard_new_blobs(ingested)
+            raise HTTPException(status_code=400, detail="Could not create submission") from e
+        finally:
+            await session.close()
+    await store_swept_blobs(ingested)
+    schedule_thumbnails(ingested)
+    await publish_submission_created(new_submission)
+    return {"message": "Submission created successfully", "submission_id": new_submission.id, "uuids": [file.id for file in ingested]}
+
+async def attachment_mime_type(attachment_id: uuid.UUID, user: User) -> str:
+    # only grants are cached, a refused user might upload the same content later
+    key = (user.id, attachment_id)
+    mime_type = attachment_access_cache.get(key)
+    if mime_type is not None:
+        return mime_type
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(Attachment.mime_type, AttachmentRef.user_id).
+            outerjoin(AttachmentRef, and_(AttachmentRef.attachment_id == Attachment.id, AttachmentRef.user_id == user.id)).
+            where(Attachment.id == attachment_id))
+        row = result.first()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Attachment not found")
+        mime_type, owner_id = row
+        if owner_id is None:
+            raise HTTPException(status_code=403, detail="User does not have access to this attachment")
+    attachment_access_cache.set(key, mime_type)
+    return mime_type
 
 @app.get("/attachments/data/{attachment_id_with_suffix}")
-async def get_attachment(attachment_id_with_suffix: str, user: User = Depends(current_active_user)):
+async def get_attachment(attachment_id_with_suffix: str, request: Request, w: Optional[int] = None, fmt: Optional[str] = None, user: User = Depends(current_active_user)):
     thumbnail = False
     if attachment_id_with_suffix.endswith("_thumbnail.jpg"):
         attachment_id = attachment_id_with_suffix[:-len("_thumbnail.jpg")]
@@ -308,16 +520,51 @@ async def get_attachment(attachment_id_with_suffix: str, user: User = Depends(cu
         attachment_id = uuid.UUID(attachment_id)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid attachment id")
-    async with async_session_maker() as session:
-        result = await session.execute(select(Attachment).where(Attachment.id == attachment_id))
-        attachment = result.scalars().first()
-        if attachment is None:
-            raise HTTPException(status_code=404, detail="Attachment not found")
-        if attachment.user_id != user.id:
-            raise HTTPException(status_code=403, detail="User does not have access to this attachment")
-        filename = f"data/{attachment_id}_thumbnail.jpg" if thumbnail else f"data/{attachment_id}.{attachment.mime_type.split('/')[-1]}"
-        media_type = "image/jpeg" if thumbnail else attachment.mime_type
-        return FileResponse(filename, media_type=media_type)
+    variant = w is not None or fmt is not None
+    if variant:
+        w = w or THUMBNAIL_SIZE[0]
+        if w not in VARIANT_WIDTHS:
+            raise HTTPException(status_code=400, detail=f"Width must be one of {VARIANT_WIDTHS}")
+        if fmt is not None and fmt not in VARIANT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Format must be one of {list(VARIANT_FORMATS)}")
+    mime_type = await attachment_mime_type(attachment_id, user)
+
+    original = original_key(attachment_id, mime_type)
+    if variant:
+        headers = {"Cache-Control": ATTACHMENT_CACHE_CONTROL}
+        if fmt is None:
+            fmt = negotiate_format(request.headers.get("accept"))
+            headers["Vary"] = "Accept"
+        headers["ETag"] = f'"{attachment_id.hex}-w{w}.{fmt}"'
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        content = await variant_cache.read(original, attachment_id, w, fmt)
+        if content is None:
+            return FileResponse(PENDING_THUMBNAIL, media_type="image/svg+xml", headers={"Cache-Control": "no-store"})
+        return Response(content=content, media_type=VARIANT_FORMATS[fmt][1], headers=headers)
+
+    # the id is the content hash, so the bytes behind a URL never change
+    etag = f'"{attachment_id.hex}-thumbnail"' if thumbnail else f'"{attachment_id.hex}"'
+    headers = {"ETag": etag, "Cache-Control": ATTACHMENT_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    # streamed from the storage backend, Range requests included
+    if not thumbnail:
+        return await storage.response(original, request, mime_type, headers)
+
+    key = thumbnail_key(attachment_id)
+    if not await storage.exists(key) and not await ensure_thumbnail(original, key):
+        # still being generated (or failed), don't let the browser cache the placeholder
+        return FileResponse(PENDING_THUMBNAIL, media_type="image/svg+xml", headers={"Cache-Control": "no-store"})
+    return await storage.response(key, request, "image/jpeg", headers)
+
+@app.get("/metrics")
+async def metrics(request: Request, current_user: User = Depends(current_active_user_optional)):
+    # Prometheus text format, for superusers and scrapers holding METRICS_TOKEN
+    if not token_allowed(request.headers.get("authorization")) and (current_user is None or not current_user.is_superuser):
+        raise HTTPException(status_code=403, detail="User is not superuser")
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/login")
 async def login(request: Request, current_user: User = Depends(current_active_user_optional)):
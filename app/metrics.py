@@ -0,0 +1,270 @@
+import bisect
+import contextvars
+import hmac
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+# no app imports here: imaging.py, which the image worker processes load, records into these too
+
+# /metrics is open to superusers, and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# adds a Server-Timing header with the time spent in the database and the upload stages
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# metrics are per worker process, a scraper sees the worker that answered
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence, le: Optional[str] = None) -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        REGISTRY.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, str(bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, '+Inf')} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Collected(Metric):
+    # values read at scrape time, e.g. cache counters that are kept elsewhere
+
+    def __init__(self, name: str, documentation: str, kind: str, labels: Sequence[str], collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in self.collect().items()]
+
+
+REGISTRY: List[Metric] = []
+
+http_requests = Counter("http_requests_total", "Requests by route and status", ["method", "route", "status"])
+http_request_duration = Histogram("http_request_duration_seconds", "Request latency until the response is complete", ["method", "route"])
+http_requests_in_flight = Gauge("http_requests_in_flight", "Requests being handled", ["method"])
+http_request_queries = Histogram("http_request_db_queries", "Database queries per request", ["method", "route"], buckets=COUNT_BUCKETS)
+http_request_db_duration = Histogram("http_request_db_duration_seconds", "Time spent in database queries per request", ["method", "route"])
+db_queries = Counter("db_queries_total", "Database queries by statement type", ["statement"])
+db_query_duration = Histogram("db_query_duration_seconds", "Database query latency by statement type", ["statement"])
+upload_stage_duration = Histogram("upload_stage_duration_seconds", "Time per uploaded file in each upload stage", ["stage"])
+
+caches: Dict[str, object] = {}
+
+
+def cache_values(attribute: str) -> Callable[[], Dict[Tuple[str, ...], float]]:
+    return lambda: {(name,): (len(cache) if attribute == "size" else getattr(cache, attribute)) for name, cache in caches.items()}
+
+
+Collected("cache_hits_total", "Cache hits", "counter", ["cache"], cache_values("hits"))
+Collected("cache_misses_total", "Cache misses", "counter", ["cache"], cache_values("misses"))
+Collected("cache_entries", "Entries held by the cache", "gauge", ["cache"], cache_values("size"))
+
+
+def register_cache(name: str, cache):
+    # anything with hits, misses and a length, like cache.LRUCache
+    caches[name] = cache
+
+
+# per request totals; SQLAlchemy runs the async drivers in greenlets that share the task's
+# context, so the engine events below see the request they belong to
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_seconds: float = 0.0
+    stages: Dict[str, float] = field(default_factory=dict)
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        kind = (statement.split(None, 1) or ["OTHER"])[0].upper()
+        db_queries.inc(kind)
+        db_query_duration.observe(elapsed, kind)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        # a failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+@contextmanager
+def stage(stages: Dict[str, float], name: str):
+    # adds the time spent in the block to stages[name]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def observe_stages(stages: Dict[str, float]):
+    # one observation per stage for a file, also counted towards the request's Server-Timing
+    stats = current_request.get()
+    for name, seconds in stages.items():
+        upload_stage_duration.observe(seconds, name)
+        if stats is not None:
+            stats.stages[name] = stats.stages.get(name, 0.0) + seconds
+
+
+def server_timing(stats: RequestStats, elapsed: float) -> str:
+    entries = [f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"']
+    entries += [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stats.stages.items()]
+    entries.append(f"app;dur={elapsed * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def route_label(route, path: str) -> str:
+    # the route template, not the path, so ids don't explode the label values. an included
+    # router's route only knows its template below the router's prefix, so the prefix is the
+    # part of the path in front of where that template matches
+    template = getattr(route, "path", None)
+    regex = getattr(route, "path_regex", None)
+    if template is None or regex is None:
+        return "unmatched"
+    start = 0
+    while start != -1:
+        if regex.match(path[start:]):
+            return path[:start] + template
+        start = path.find("/", start + 1)
+    return template
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        path = scope["path"]
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    timing = server_timing(stats, time.perf_counter() - start)
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        http_requests_in_flight.inc(method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec(method)
+            current_request.reset(token)
+            route = route_label(scope.get("route"), path)
+            elapsed = time.perf_counter() - start
+            http_requests.inc(method, route, str(status))
+            http_request_duration.observe(elapsed, method, route)
+            http_request_queries.observe(stats.queries, method, route)
+            http_request_db_duration.observe(stats.db_seconds, method, route)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def token_allowed(authorization: Optional[str]) -> bool:
+    if METRICS_TOKEN is None or authorization is None:
+        return False
+    return hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode())
@@ -0,0 +1,212 @@
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String, and_, select, func, literal, tuple_
+
+from db import (
+    Base,
+    engine,
+    Applications,
+    ApplicationAssignment,
+    Submission,
+    Attachment,
+    AttachmentRef,
+    LeaderboardEntry,
+    attachment_ids,
+)
+
+# multi-worker deployments should run `python migrations.py` once and set this to false
+RUN_MIGRATIONS_ON_STARTUP = os.environ.get("RUN_MIGRATIONS_ON_STARTUP", "true").lower() == "true"
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+# (version, description, function taking a sync connection), applied in version order
+MIGRATIONS = []
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+@migration(1, "Backfill attachment_refs from Attachment.user_id and Submission.attachments")
+def backfill_attachment_refs(conn):
+    # databases from before attachment_refs existed: the uploader owns the blob and
+    # every submission that lists it holds a reference
+    if conn.execute(select(func.count()).select_from(AttachmentRef)).scalar() > 0:
+        return
+    counts = {}
+    for user_id, attachments in conn.execute(select(Submission.user_id, Submission.attachments)):
+        for attachment_id in attachment_ids(attachments):
+            counts[(attachment_id, user_id)] = counts.get((attachment_id, user_id), 0) + 1
+    rows = [
+        {"attachment_id": attachment_id, "user_id": user_id, "desc": desc, "ref_count": counts.get((attachment_id, user_id), 0)}
+        for attachment_id, user_id, desc in conn.execute(select(Attachment.id, Attachment.user_id, Attachment.desc))
+    ]
+    if rows:
+        conn.execute(AttachmentRef.__table__.insert(), rows)
+
+
+@migration(2, "Indexes for the submission, attachment and assignment lookups")
+def add_lookup_indexes(conn):
+    # create_all only creates indexes together with their table, existing databases need them added.
+    # each migration spells out its indexes so it builds the same schema whatever the models say later
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_submissions_user_application_created ON submissions (user_id, application_id, created_at DESC)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_attachments_user_id ON attachments (user_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_attachment_refs_user_id ON attachment_refs (user_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_application_assignments_application_id ON application_assignments (application_id)")
+
+
+@migration(3, "Keyset pagination indexes for submissions")
+def add_submission_keyset_indexes(conn):
+    # replaces migration 2's index, id breaks ties between equal timestamps
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_submissions_user_application_created")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_submissions_user_application_keyset ON submissions (user_id, application_id, created_at DESC, id DESC)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_submissions_user_keyset ON submissions (user_id, created_at DESC, id DESC)")
+
+
+@migration(4, "Build leaderboard_entries from the existing submissions")
+def backfill_leaderboard(conn):
+    if conn.execute(select(func.count()).select_from(LeaderboardEntry)).scalar() > 0:
+        return
+    conn.execute(LeaderboardEntry.__table__.insert().from_select(
+        ["application_id", "user_id", "submission_count", "latest_submission_at", "score"],
+        select(Submission.application_id, Submission.user_id, func.count(), func.max(Submission.created_at), literal(0)).
+        where(Submission.application_id.is_not(None), Submission.user_id.is_not(None)).
+        group_by(Submission.application_id, Submission.user_id)))
+
+
+@migration(5, "Index for exporting an application's submissions")
+def add_submission_export_index(conn):
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_submissions_application_id ON submissions (application_id, id)")
+
+
+@migration(6, "Index for the sweeper's unreferenced attachment lookup")
+def add_unreferenced_attachment_index(conn):
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_attachment_refs_unreferenced ON attachment_refs (created_at) WHERE ref_count = 0")
+
+
+@migration(7, "Full-text index over submission texts")
+def add_submission_search_index(conn):
+    if conn.dialect.name == "postgresql":
+        # the same expression search.py matches against
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_submissions_search ON submissions "
+            "USING gin (to_tsvector('simple'::regconfig, coalesce(submission, '')))")
+        return
+    # an external content FTS5 table: the text stays in submissions, the triggers keep the index in
+    # step with every write, whichever code path makes it
+    conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS submissions_fts USING fts5("
+        "submission, content='submissions', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS submissions_fts_insert AFTER INSERT ON submissions BEGIN "
+        "INSERT INTO submissions_fts(rowid, submission) VALUES (new.id, new.submission); END")
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS submissions_fts_delete AFTER DELETE ON submissions BEGIN "
+        "INSERT INTO submissions_fts(submissions_fts, rowid, submission) VALUES ('delete', old.id, old.submission); END")
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS submissions_fts_update AFTER UPDATE OF submission ON submissions BEGIN "
+        "INSERT INTO submissions_fts(submissions_fts, rowid, submission) VALUES ('delete', old.id, old.submission); "
+        "INSERT INTO submissions_fts(rowid, submission) VALUES (new.id, new.submission); END")
+    # index the submissions that are already there
+    conn.exec_driver_sql("INSERT INTO submissions_fts(submissions_fts) VALUES ('rebuild')")
+
+
+def run_migrations(conn):
+    # new tables (and their indexes) come from the models, everything else is a numbered migration
+    Base.metadata.create_all(conn)
+    applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+    for version, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        print(f"Applying migration {version}: {description}")
+        fn(conn)
+        conn.execute(SchemaMigration.__table__.insert().values(version=version, description=description, applied_at=datetime.utcnow()))
+
+
+async def migrate():
+    async with engine.begin() as conn:
+        await conn.run_sync(run_migrations)
+
+
+async def migrate_cli():
+    await migrate()
+    await engine.dispose()
+
+
+def hot_queries():
+    # the query shapes behind every page load, these must never fall back to a table scan
+    user_id = uuid.UUID(int=0)
+    return {
+        "submissions by user and application": select(Submission).
+            where(Submission.user_id == user_id, Submission.application_id == 1).
+            where(tuple_(Submission.created_at, Submission.id) < tuple_(datetime.utcnow(), 1)).
+            order_by(Submission.created_at.desc(), Submission.id.desc()),
+        "submissions by user": select(Submission).
+            where(Submission.user_id == user_id).
+            where(tuple_(Submission.created_at, Submission.id) < tuple_(datetime.utcnow(), 1)).
+            order_by(Submission.created_at.desc(), Submission.id.desc()),
+        "assignments of a user": select(ApplicationAssignment, Applications).
+            join(Applications, ApplicationAssignment.application_id == Applications.id).
+            where(ApplicationAssignment.user_id == user_id),
+        "assignments of an application": select(ApplicationAssignment).
+            where(ApplicationAssignment.application_id == 1),
+        "attachments of a user": select(Attachment).
+            where(Attachment.user_id == user_id),
+        "application leaderboard": select(LeaderboardEntry).
+            where(LeaderboardEntry.application_id == 1).
+            order_by(LeaderboardEntry.score.desc(), LeaderboardEntry.submission_count.desc(), LeaderboardEntry.latest_submission_at).
+            limit(10),
+        "attachment access": select(Attachment.mime_type, AttachmentRef.user_id).
+            outerjoin(AttachmentRef, and_(AttachmentRef.attachment_id == Attachment.id, AttachmentRef.user_id == user_id)).
+            where(Attachment.id == user_id),
+    }
+
+
+def check_query_plans(conn) -> list:
+    # returns (query, plan step) for every hot query step that scans or sorts a whole table
+    if conn.dialect.name != "sqlite":
+        return []
+    regressions = []
+    for name, query in hot_queries().items():
+        sql = str(query.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+        for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"):
+            # SEARCH is an index lookup, SCAN walks the whole table (or a whole index), and a
+            # temp b-tree means sorting every matching row before the first one can be returned
+            detail = row[-1]
+            if detail.startswith("SCAN ") or detail.startswith("USE TEMP B-TREE"):
+                regressions.append((name, detail))
+    return regressions
+
+
+async def check():
+    async with engine.connect() as conn:
+        regressions = await conn.run_sync(check_query_plans)
+    await engine.dispose()
+    return regressions
+
+
+if __name__ == "__main__":
+    # python migrations.py         apply pending migrations
+    # python migrations.py check   fail if a hot query plans a full table scan
+    if sys.argv[1:] == ["check"]:
+        regressions = asyncio.run(check())
+        for name, detail in regressions:
+            print(f"{name}: {detail}")
+        sys.exit(1 if regressions else 0)
+    asyncio.run(migrate_cli())
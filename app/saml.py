@@ -1,10 +1,17 @@
+from typing import Optional, Tuple
+
 from fastapi import APIRouter, Request
 from fastapi.responses import RedirectResponse, Response
+from starlette.concurrency import run_in_threadpool
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.errors import OneLogin_Saml2_Error
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
 
+import hashlib
 import secrets
 import os
 from users import get_user_by_email, manual_register, manual_login, UserCreate
+from cache import etag_matches
 
 router = APIRouter(
     prefix="/saml",
@@ -52,8 +59,26 @@ saml_settings = {
     }
 }
 
+# the parsed settings (certificate included) and the SP metadata with its ETag, both built once
+parsed_saml_settings: Optional[OneLogin_Saml2_Settings] = None
+sp_metadata: Optional[Tuple[str, str]] = None
+
+def get_saml_settings() -> OneLogin_Saml2_Settings:
+    global parsed_saml_settings
+    if parsed_saml_settings is None:
+        parsed_saml_settings = OneLogin_Saml2_Settings(saml_settings)
+    return parsed_saml_settings
+
+def load_saml_settings():
+    # called at startup so a login storm does not start with every request parsing the settings;
+    # SAML stays optional, without HOSTNAME and the IdP settings only the /saml routes fail
+    try:
+        get_saml_settings()
+    except OneLogin_Saml2_Error as e:
+        print(f"SAML is not configured: {e}")
+
 def init_saml_auth(req):
-    auth = OneLogin_Saml2_Auth(req, saml_settings)
+    auth = OneLogin_Saml2_Auth(req, get_saml_settings())
     return auth
 
 async def prepare_fastapi_request(request: Request):
@@ -78,7 +103,8 @@ async def saml_login(request: Request):
 async def saml_acs(request: Request):
     req = await prepare_fastapi_request(request)
     auth = init_saml_auth(req)
-    auth.process_response()
+    # XML parsing and signature checks are CPU work, keep them off the event loop
+    await run_in_threadpool(auth.process_response)
     errors = auth.get_errors()
     if len(errors) == 0:
         if auth.is_authenticated():
@@ -102,12 +128,17 @@ async def saml_acs(request: Request):
 
 @router.get("/metadata")
 async def saml_metadata(request: Request):
-    req = prepare_fastapi_request(request)
-    auth = init_saml_auth(req)
-    settings = auth.get_settings()
-    metadata = settings.get_sp_metadata()
-    errors = settings.validate_metadata(metadata)
-    if len(errors) == 0:
-        return Response(content=metadata, media_type="application/xml")
-    else:
-        return Response(content=f"Error when processing SAML Metadata: {', '.join(errors)}", status_code=400)
\ No newline at end of file
+    global sp_metadata
+    # the metadata only depends on the settings, generate and validate it once
+    if sp_metadata is None:
+        settings = get_saml_settings()
+        metadata = settings.get_sp_metadata()
+        errors = settings.validate_metadata(metadata)
+        if len(errors) != 0:
+            return Response(content=f"Error when processing SAML Metadata: {', '.join(errors)}", status_code=400)
+        sp_metadata = (metadata, f'"{hashlib.sha256(metadata.encode()).hexdigest()}"')
+    metadata, etag = sp_metadata
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=metadata, media_type="application/xml", headers=headers)
\ No newline at end of file
@@ -1,6 +1,9 @@
 import uuid
+from datetime import datetime
+from typing import Any, List, Optional
 
 from fastapi_users import schemas
+from pydantic import BaseModel, ConfigDict
 
 
 class UserRead(schemas.BaseUser[uuid.UUID]):
@@ -12,4 +15,110 @@ class UserCreate(schemas.BaseUserCreate):
 
 
 class UserUpdate(schemas.BaseUserUpdate):
-    pass
\ No newline at end of file
+    pass
+
+# response models: the API returns exactly these fields, and FastAPI serializes them straight
+# to JSON bytes in pydantic-core instead of walking ORM objects with jsonable_encoder
+
+class ApplicationRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: Optional[str] = None
+    is_active: Optional[bool] = None
+    description: Optional[str] = None
+    instructions: Optional[str] = None
+
+
+class ApplicationPage(BaseModel):
+    applications: List[ApplicationRead]
+    next_cursor: Optional[str] = None
+
+
+class AssignedApplication(BaseModel):
+    id: int
+    name: Optional[str] = None
+    description: Optional[str] = None
+    instructions: Optional[str] = None
+
+
+class ApplicationAssignmentRead(BaseModel):
+    user_id: uuid.UUID
+    application_id: int
+    is_admin: Optional[bool] = None
+    application: AssignedApplication
+
+
+class ApplicationAssignmentList(BaseModel):
+    application_assignments: List[ApplicationAssignmentRead]
+
+
+class SubmissionRead(BaseModel):
+    # every field is optional because listings can project a subset of them
+    model_config = ConfigDict(from_attributes=True)
+
+    id: Optional[int] = None
+    application_id: Optional[int] = None
+    user_id: Optional[uuid.UUID] = None
+    submission: Optional[str] = None
+    attachments: Any = None
+    created_at: Optional[datetime] = None
+
+
+class SubmissionPage(BaseModel):
+    submissions: List[SubmissionRead]
+    next_cursor: Optional[str] = None
+
+
+class SubmissionSearchResult(BaseModel):
+    id: int
+    application_id: Optional[int] = None
+    user_id: Optional[uuid.UUID] = None
+    email: Optional[str] = None
+    created_at: Optional[datetime] = None
+    # HTML escaped text around the matches, which are wrapped in <mark>
+    snippet: Optional[str] = None
+
+
+class SubmissionSearchPage(BaseModel):
+    results: List[SubmissionSearchResult]
+    next_cursor: Optional[str] = None
+
+
+class DashboardAssignment(ApplicationAssignmentRead):
+    submissions: List[SubmissionRead]
+    next_cursor: Optional[str] = None
+
+
+class Dashboard(BaseModel):
+    application_assignments: List[DashboardAssignment]
+
+
+# the fields sent next to the files of a multipart upload
+
+class AttachmentUploadFields(BaseModel):
+    desc: str
+
+
+class SubmissionUploadFields(BaseModel):
+    application_id: int
+    submission: str = ""
+    desc: str = ""
+
+
+# bulk import rows, CSV cells arrive as strings and are coerced here
+
+class BulkApplication(BaseModel):
+    name: str
+    is_active: bool = True
+    description: Optional[str] = None
+    instructions: Optional[str] = None
+
+
+class BulkAssignment(BaseModel):
+    # the user by email or id, the application by id or name
+    email: Optional[str] = None
+    user_id: Optional[uuid.UUID] = None
+    application_id: Optional[int] = None
+    application: Optional[str] = None
+    is_admin: bool = False
@@ -0,0 +1,118 @@
+import html
+import os
+import re
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import and_, column, func, literal_column, or_, select, table
+
+from db import User, Submission, async_session_maker, engine, user_emails
+from leaderboard import check_board_access
+from pagination import DEFAULT_PAGE_SIZE, check_limit, encode_cursor, decode_score_cursor
+from schemas import SubmissionSearchPage
+from users import current_active_user
+
+router = APIRouter()
+
+# words of context around the matches in a snippet
+SEARCH_SNIPPET_WORDS = int(os.environ.get("SEARCH_SNIPPET_WORDS", "16"))
+SEARCH_MAX_TERMS = 16
+
+# the database marks matches with these, they are turned into <mark> after escaping the text
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# SQLite: the FTS5 table from migration 7, kept up to date by triggers on submissions
+submissions_fts = table("submissions_fts", column("rowid"), column("submissions_fts"))
+
+
+def fts5_query(q: str) -> str:
+    # every word must match, as a quoted string so FTS5 operators in the input are plain text.
+    # a trailing * keeps its meaning of a prefix search
+    terms = []
+    for word in re.findall(r"[^\s\"]+", q)[:SEARCH_MAX_TERMS]:
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search_query(q: str):
+    # (match condition, score where lower is better, snippet) for the configured database
+    if engine.dialect.name == "postgresql":
+        # the expression must stay the one migration 7 indexes
+        config = literal_column("'simple'::regconfig")
+        text = func.coalesce(Submission.submission, literal_column("''"))
+        tsquery = func.websearch_to_tsquery(config, q)
+        snippet = func.ts_headline(config, text, tsquery,
+            f"StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords={SEARCH_SNIPPET_WORDS * 2}, MinWords={SEARCH_SNIPPET_WORDS // 2}")
+        return func.to_tsvector(config, text).op("@@")(tsquery), -func.ts_rank_cd(func.to_tsvector(config, text), tsquery), snippet
+    match = fts5_query(q)
+    if not match:
+        raise HTTPException(status_code=400, detail="q must contain a word to search for")
+    fts = literal_column("submissions_fts")
+    return (
+        submissions_fts.c.submissions_fts.op("MATCH")(match),
+        func.bm25(fts),
+        func.snippet(fts, -1, MATCH_START, MATCH_END, "…", SEARCH_SNIPPET_WORDS),
+    )
+
+
+def highlight(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+
+@router.get("/submissions/search", response_model=SubmissionSearchPage)
+async def search_submissions(
+        q: str,
+        application_id: Optional[int] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        user: User = Depends(current_active_user)
+    ):
+    # best matches first. superusers search everything, an application's admins its submissions
+    check_limit(limit)
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="q must contain a word to search for")
+    condition, score, snippet = search_query(q)
+    query = (
+        select(Submission.id, Submission.application_id, Submission.user_id, Submission.created_at, snippet.label("snippet"), score.label("score")).
+        where(condition).
+        order_by(score, Submission.id).
+        limit(limit + 1)
+    )
+    if engine.dialect.name != "postgresql":
+        query = query.select_from(submissions_fts).join(Submission, Submission.id == submissions_fts.c.rowid)
+    if application_id is not None:
+        query = query.where(Submission.application_id == application_id)
+
+    # continue after the last result of the previous page
+    if cursor is not None:
+        last_score, last_id = decode_score_cursor(cursor)
+        query = query.where(or_(score > last_score, and_(score == last_score, Submission.id > last_id)))
+
+    async with async_session_maker() as session:
+        if application_id is None:
+            if not user.is_superuser:
+                raise HTTPException(status_code=403, detail="User is not superuser")
+        else:
+            await check_board_access(session, application_id, user, admin=True)
+        rows = (await session.execute(query)).all()
+        emails = await user_emails(session, (row.user_id for row in rows))
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.score, last.id)
+    results = [{
+        "id": row.id,
+        "application_id": row.application_id,
+        "user_id": row.user_id,
+        "email": emails.get(row.user_id),
+        "created_at": row.created_at,
+        "snippet": highlight(row.snippet),
+    } for row in rows[:limit]]
+    return {"results": results, "next_cursor": next_cursor}
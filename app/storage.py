@@ -0,0 +1,302 @@
+import asyncio
+import os
+import re
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+
+# where originals and thumbnails are kept: "local" (STORAGE_DIR) or "s3" (S3_BUCKET)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+STORAGE_DIR = os.environ.get("STORAGE_DIR", os.path.join(DATA_DIR, "blobs"))
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+# for S3 compatible services such as MinIO; credentials come from the usual AWS_* variables
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_REGION = os.environ.get("S3_REGION")
+
+CHUNK_SIZE = 1024 * 64 # 64KB
+
+# blobs are named after their content hash, {uuid}.{ext} and {uuid}_thumbnail.jpg
+BLOB_NAME = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(\.[a-z]+|_thumbnail\.jpg)$")
+
+
+def original_key(attachment_id, mime_type: str) -> str:
+    return f"{attachment_id}.{mime_type.split('/')[-1]}"
+
+
+def thumbnail_key(attachment_id) -> str:
+    return f"{attachment_id}_thumbnail.jpg"
+
+
+def shard(key: str) -> str:
+    # ab/cd/<key> from the leading hash digits, 65536 directories of a few entries each
+    return f"{key[0:2]}/{key[2:4]}/{key}"
+
+
+def fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LocalStorage:
+    # blobs under directory/ab/cd/<key>. the files written before the sharded layout sit flat in
+    # legacy_dir and are still found there until `python storage.py migrate` has moved them
+
+    def __init__(self, directory: str, legacy_dir: Optional[str] = None):
+        self.directory = directory
+        self.legacy_dir = legacy_dir
+        os.makedirs(directory, exist_ok=True)
+        # temp files live on the same filesystem so they can be renamed into place
+        self.staging_dir = directory
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, shard(key))
+
+    def locate(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        if os.path.exists(path):
+            return path
+        if self.legacy_dir is not None:
+            legacy = os.path.join(self.legacy_dir, key)
+            if os.path.exists(legacy):
+                return legacy
+        return None
+
+    # locate stats the disk: like the writes below, the async methods run it in the thread pool
+
+    async def exists(self, key: str) -> bool:
+        return await run_in_threadpool(self.locate, key) is not None
+
+    def _store(self, key: str, tmp_path: str):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.makedirs(directory, exist_ok=True)
+        os.replace(tmp_path, path)
+        fsync_dir(directory)
+
+    async def store(self, key: str, tmp_path: str):
+        # takes ownership of a finished temp file: fsync it, rename it into place, fsync the directory.
+        # on failure the temp file is left to the caller. an fsync can take a while, it runs in a thread
+        await run_in_threadpool(self._store, key, tmp_path)
+
+    def _delete(self, key: str):
+        for path in filter(None, [self.path(key), self.legacy_dir and os.path.join(self.legacy_dir, key)]):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def delete(self, key: str):
+        await run_in_threadpool(self._delete, key)
+
+    @asynccontextmanager
+    async def local_copy(self, key: str) -> AsyncIterator[str]:
+        path = await run_in_threadpool(self.locate, key)
+        if path is None:
+            raise FileNotFoundError(key)
+        yield path
+
+    async def iter_chunks(self, key: str) -> AsyncIterator[bytes]:
+        path = await run_in_threadpool(self.locate, key)
+        if path is None:
+            raise FileNotFoundError(key)
+        f = await run_in_threadpool(open, path, "rb")
+        try:
+            while chunk := await run_in_threadpool(f.read, CHUNK_SIZE):
+                yield chunk
+        finally:
+            f.close()
+
+    async def response(self, key: str, request: Request, media_type: str, headers: Dict[str, str]) -> Response:
+        # FileResponse takes care of Range/If-Range requests using the ETag in headers, and of
+        # reading the file in a thread
+        path = await run_in_threadpool(self.locate, key)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Attachment data not found")
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+
+class S3Storage:
+    # blobs in a bucket under prefix + ab/cd/<key>. boto3 is blocking, every call goes through the
+    # thread pool; images are processed from a local temp copy
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None, region: Optional[str] = None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3, pip install boto3") from e
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client_error = ClientError
+        # nothing is cached about which keys exist: the sweeper deletes blobs, and an upload that
+        # trusted another worker's stale answer would skip storing one
+        self.staging_dir = tempfile.gettempdir()
+
+    def object_key(self, key: str) -> str:
+        return self.prefix + shard(key)
+
+    def is_missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await run_in_threadpool(self.client.head_object, Bucket=self.bucket, Key=self.object_key(key))
+        except self.client_error as e:
+            if self.is_missing(e):
+                return False
+            raise
+        return True
+
+    async def store(self, key: str, tmp_path: str):
+        # a PUT is atomic, readers see the whole object or none of it
+        await run_in_threadpool(self.client.upload_file, tmp_path, self.bucket, self.object_key(key))
+        os.unlink(tmp_path)
+
+    async def delete(self, key: str):
+        await run_in_threadpool(self.client.delete_object, Bucket=self.bucket, Key=self.object_key(key))
+
+    async def get_object(self, key: str, **kwargs) -> dict:
+        try:
+            return await run_in_threadpool(self.client.get_object, Bucket=self.bucket, Key=self.object_key(key), **kwargs)
+        except self.client_error as e:
+            if self.is_missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    @asynccontextmanager
+    async def local_copy(self, key: str) -> AsyncIterator[str]:
+        fd, path = tempfile.mkstemp(dir=self.staging_dir, prefix=".download-", suffix=".tmp")
+        os.close(fd)
+        try:
+            try:
+                await run_in_threadpool(self.client.download_file, self.bucket, self.object_key(key), path)
+            except self.client_error as e:
+                if self.is_missing(e):
+                    raise FileNotFoundError(key) from e
+                raise
+            yield path
+        finally:
+            os.unlink(path)
+
+    async def iter_chunks(self, key: str) -> AsyncIterator[bytes]:
+        body = (await self.get_object(key))["Body"]
+        try:
+            async for chunk in iterate_in_threadpool(body.iter_chunks(CHUNK_SIZE)):
+                yield chunk
+        finally:
+            body.close()
+
+    async def response(self, key: str, request: Request, media_type: str, headers: Dict[str, str]) -> Response:
+        # ranges are passed on to S3, unless If-Range names a different version than ours
+        kwargs = {}
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range == headers.get("ETag")):
+            kwargs["Range"] = range_header
+        try:
+            obj = await self.get_object(key, **kwargs)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Attachment data not found")
+        except self.client_error as e:
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                raise HTTPException(status_code=416, detail="Range not satisfiable")
+            raise
+        headers = {
+            **headers,
+            "Accept-Ranges": "bytes",
+            "Content-Length": str(obj["ContentLength"]),
+            "Last-Modified": obj["LastModified"].strftime("%a, %d %b %Y %H:%M:%S GMT"),
+        }
+        status_code = 200
+        if "ContentRange" in obj:
+            headers["Content-Range"] = obj["ContentRange"]
+            status_code = 206
+        body = obj["Body"]
+
+        async def stream():
+            try:
+                async for chunk in iterate_in_threadpool(body.iter_chunks(CHUNK_SIZE)):
+                    yield chunk
+            finally:
+                body.close()
+
+        return StreamingResponse(stream(), status_code=status_code, media_type=media_type, headers=headers)
+
+
+def make_storage():
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(STORAGE_DIR, legacy_dir=DATA_DIR)
+    if STORAGE_BACKEND == "s3":
+        if not S3_BUCKET:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND}, use local or s3")
+
+
+storage = make_storage()
+
+
+@asynccontextmanager
+async def staged(key: str) -> AsyncIterator[str]:
+    # a temp path to write a new blob to, stored under key if the block completes
+    fd, tmp_path = tempfile.mkstemp(dir=storage.staging_dir, prefix=".upload-", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    try:
+        await storage.store(key, tmp_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+async def migrate(dry_run: bool = False) -> int:
+    # moves the blobs of the old flat layout (DATA_DIR/{key}) into the configured storage. one file
+    # at a time and idempotent, so it can run next to the app and be restarted when interrupted
+    moved = 0
+    for entry in os.scandir(DATA_DIR):
+        if not entry.is_file() or not BLOB_NAME.match(entry.name):
+            continue
+        moved += 1
+        if dry_run:
+            print(f"would move {entry.name}")
+            continue
+        # a rename for local storage, an upload and unlink for S3; a failure leaves the file where it was
+        await storage.store(entry.name, entry.path)
+        if moved % 1000 == 0:
+            print(f"{moved} files moved")
+    return moved
+
+
+if __name__ == "__main__":
+    # python storage.py migrate [--dry-run]   move blobs from the flat data/ layout into storage
+    if sys.argv[1:2] != ["migrate"]:
+        sys.exit("usage: python storage.py migrate [--dry-run]")
+    count = asyncio.run(migrate(dry_run="--dry-run" in sys.argv[2:]))
+    print(f"{count} files {'to move' if '--dry-run' in sys.argv[2:] else 'moved'} to {STORAGE_BACKEND} storage")
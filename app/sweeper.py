@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, exists, literal_column, select, tuple_
+
+from db import Attachment, AttachmentRef, async_session_maker, attachment_access_cache, engine
+from metrics import Counter
+from storage import storage, original_key, thumbnail_key
+from variants import variant_cache
+
+# removes what no submission points at any more, in two passes:
+#   1. refs with ref_count 0 older than SWEEP_GRACE: uploads whose submission never came, or whose
+#      submissions were all deleted. the uploader loses access to the blob
+#   2. attachments without any ref left: the rows are deleted and the files removed in one
+#      transaction, an upload of the same content waits for it and then stores the file again
+# ref_count is kept in step with Submission.attachments by every submission write, see main.py
+
+# multi-worker deployments should enable this in one worker only, or run `python sweeper.py` from cron
+SWEEPER_ENABLED = os.environ.get("SWEEPER_ENABLED", "true").lower() == "true"
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", "3600")) # seconds between sweeps
+SWEEP_GRACE = float(os.environ.get("SWEEP_GRACE", str(60 * 60 * 24))) # seconds an unreferenced upload is kept
+# every batch is a short transaction followed by a pause, so requests never wait long for the database
+SWEEP_BATCH_SIZE = int(os.environ.get("SWEEP_BATCH_SIZE", "100"))
+SWEEP_BATCH_PAUSE = float(os.environ.get("SWEEP_BATCH_PAUSE", "0.5")) # seconds
+
+swept = Counter("sweeper_removed_total", "Rows removed by the attachment sweeper", ["kind"])
+
+
+@dataclass
+class SweepResult:
+    refs: int = 0
+    attachments: int = 0
+
+
+async def expire_refs(cutoff: datetime, limit: int) -> int:
+    # the conditions are checked again in the DELETE, a ref that was used or uploaded again since
+    # it was selected stays
+    unreferenced = (AttachmentRef.ref_count == literal_column("0"), AttachmentRef.created_at < cutoff)
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(AttachmentRef.attachment_id, AttachmentRef.user_id).where(*unreferenced).limit(limit))
+        keys = [tuple(row) for row in result]
+        if not keys:
+            return 0
+        result = await session.execute(
+            delete(AttachmentRef).
+            where(tuple_(AttachmentRef.attachment_id, AttachmentRef.user_id).in_(keys), *unreferenced).
+            returning(AttachmentRef.attachment_id, AttachmentRef.user_id))
+        removed = result.all()
+        await session.commit()
+    for attachment_id, user_id in removed:
+        attachment_access_cache.pop((user_id, attachment_id))
+    return len(removed)
+
+
+async def remove_orphans(after: Optional[uuid.UUID], limit: int) -> tuple:
+    # one batch of attachments without refs in id order after the given id. returns how many were
+    # removed and the id to continue after, None once there are no more
+    no_refs = ~exists().where(AttachmentRef.attachment_id == Attachment.id)
+    async with async_session_maker() as session:
+        query = select(Attachment.id).where(no_refs).order_by(Attachment.id).limit(limit)
+        if after is not None:
+            query = query.where(Attachment.id > after)
+        candidates = list((await session.execute(query)).scalars())
+    if not candidates:
+        return 0, None
+
+    async with async_session_maker() as session:
+        if engine.dialect.name == "postgresql":
+            # waits for uploads of these blobs still in their transaction. the DELETE below then
+            # sees their refs, and new ones wait for our commit
+            await session.execute(select(Attachment.id).where(Attachment.id.in_(candidates)).with_for_update())
+        # on SQLite this takes the write lock, the uploads wait for our commit the same way
+        result = await session.execute(
+            delete(Attachment).
+            where(Attachment.id.in_(candidates), no_refs).
+            returning(Attachment.id, Attachment.mime_type))
+        removed = result.all()
+        # the files go before the commit: an upload that waited finds them missing and stores its
+        # copy again. if this fails half way the rows roll back and are swept the next time
+        for attachment_id, mime_type in removed:
+            await storage.delete(original_key(attachment_id, mime_type))
+            await storage.delete(thumbnail_key(attachment_id))
+            variant_cache.discard(attachment_id)
+        await session.commit()
+    return len(removed), candidates[-1]
+
+
+async def sweep(grace: float = SWEEP_GRACE, batch_size: int = SWEEP_BATCH_SIZE, pause: float = SWEEP_BATCH_PAUSE) -> SweepResult:
+    result = SweepResult()
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    while True:
+        removed = await expire_refs(cutoff, batch_size)
+        result.refs += removed
+        swept.inc("ref", amount=removed)
+        if removed < batch_size:
+            break
+        await asyncio.sleep(pause)
+
+    after = None
+    while True:
+        removed, after = await remove_orphans(after, batch_size)
+        result.attachments += removed
+        swept.inc("attachment", amount=removed)
+        if after is None:
+            break
+        await asyncio.sleep(pause)
+    return result
+
+
+async def run_sweeper():
+    # the lifespan task: a sweep every SWEEP_INTERVAL, starting one interval after startup
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            result = await sweep()
+            if result.refs or result.attachments:
+                print(f"Sweeper removed {result.refs} unreferenced uploads and {result.attachments} attachments")
+        except Exception as e:
+            print(f"Sweep failed: {e!r}")
+
+
+async def sweep_cli(grace: float):
+    result = await sweep(grace=grace)
+    print(f"Removed {result.refs} unreferenced uploads and {result.attachments} attachments")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    # python sweeper.py [grace seconds]   run one sweep now
+    asyncio.run(sweep_cli(float(sys.argv[1]) if sys.argv[1:] else SWEEP_GRACE))
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import tempfile
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Type
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+from PIL import UnidentifiedImageError
+from sqlalchemy import select
+
+from db import Attachment, AttachmentRef, async_session_maker
+from imaging import sniff_mime, check_image, ImageTooLarge
+from metrics import stage, observe_stages
+from storage import storage, original_key
+
+MAX_UPLOAD_SIZE = 1024 * 1024 * 4 # 4MB
+ALLOWED_MIME_TYPES = ["image/jpeg", "image/png"]
+# the form fields next to the files are small, and a request has only so many parts
+MAX_FIELD_SIZE = 1024 * 64 # 64KB
+MAX_PARTS = int(os.environ.get("MAX_UPLOAD_PARTS", "100"))
+# libmagic looks at the start of the file, this much of it is collected before sniffing
+SNIFF_SIZE = 1024 * 8 # 8KB
+# the form field holding the files
+FILE_FIELD = "fileAttach"
+
+
+@dataclass
+class IngestedFile:
+    id: uuid.UUID
+    mime_type: str
+    key: str
+    size: int
+    created: bool
+    # for a blob that was already stored: this upload's own copy, kept until the commit in case
+    # a sweep removes the stored one meanwhile, see store_swept_blobs
+    tmp_path: Optional[str] = None
+
+
+class FileReceiver:
+    # one file part of the body as it arrives: hashed and written to a temp file the storage can
+    # take over in a single pass, and refused as soon as it is too large or not an image
+
+    def __init__(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=storage.staging_dir, prefix=".upload-", suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.mime_type: Optional[str] = None
+        # seconds spent in each stage of this file
+        self.stages: Dict[str, float] = {}
+
+    def _consume(self, data: bytes):
+        with stage(self.stages, "hash"):
+            self.hasher.update(data)
+        with stage(self.stages, "write"):
+            self.file.write(data)
+
+    async def _sniff(self):
+        with stage(self.stages, "sniff"):
+            self.mime_type = await run_in_threadpool(sniff_mime, self.head)
+        if self.mime_type not in ALLOWED_MIME_TYPES:
+            raise HTTPException(status_code=400, detail="Only image/jpeg and image/png are allowed")
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=400, detail=f"File size too large. Max file size is {MAX_UPLOAD_SIZE} bytes")
+        if self.mime_type is None:
+            self.head += data[:SNIFF_SIZE]
+            if len(self.head) >= SNIFF_SIZE:
+                await self._sniff()
+        # hashing and writing stay off the event loop
+        await run_in_threadpool(self._consume, data)
+
+    async def finish(self) -> IngestedFile:
+        if self.mime_type is None:
+            if not self.head:
+                raise HTTPException(status_code=400, detail="Only image/jpeg and image/png are allowed")
+            await self._sniff()
+        self.file.close()
+
+        file_uuid = uuid.UUID(self.hasher.hexdigest()[:32])
+        key = original_key(file_uuid, self.mime_type)
+
+        # content addressed: if the blob is already stored there is nothing left to write
+        created = not await storage.exists(key)
+        if created:
+            # refuse images that would blow the decode budget before they are stored
+            try:
+                with stage(self.stages, "validate"):
+                    await run_in_threadpool(check_image, self.tmp_path)
+            except ImageTooLarge as e:
+                raise HTTPException(status_code=400, detail=f"Image too large. {e}")
+            except (UnidentifiedImageError, OSError, SyntaxError) as e:
+                raise HTTPException(status_code=400, detail="File is not a valid image") from e
+            # the storage fsyncs and renames (or uploads) the temp file
+            with stage(self.stages, "write"):
+                await storage.store(key, self.tmp_path)
+
+        observe_stages(self.stages)
+        return IngestedFile(id=file_uuid, mime_type=self.mime_type, key=key, size=self.size, created=created, tmp_path=None if created else self.tmp_path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+@dataclass
+class UploadForm:
+    fields: BaseModel
+    files: List[IngestedFile] = field(default_factory=list)
+
+
+class FormReceiver:
+    # multipart/form-data read straight off the request stream. Request.form() would spool every
+    # file to a temp file of its own first, in full and whatever its size; here each file is
+    # ingested while it arrives, and the request stops being read at the first one refused.
+    # the parser callbacks only collect what they see, it is handled after each chunk
+
+    def __init__(self):
+        self.events = []
+        self.header_name = b""
+        self.header_value = b""
+        self.headers: Dict[bytes, bytes] = {}
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_name.lower()] = self.header_value
+        self.header_name = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        self.events.append(("part", self.headers))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self.events.append(("data", data[start:end]))
+
+    def on_part_end(self):
+        self.events.append(("end", None))
+
+    def callbacks(self) -> dict:
+        return {name: getattr(self, name) for name in (
+            "on_part_begin", "on_header_field", "on_header_value", "on_header_end",
+            "on_headers_finished", "on_part_data", "on_part_end")}
+
+
+async def receive_multipart(request: Request, boundary: bytes, values: Dict[str, str], ingested: List[IngestedFile]):
+    # fills in values and ingested as the parts arrive. on an error the caller discards ingested
+    receiver = FormReceiver()
+    parser = MultipartParser(boundary, receiver.callbacks())
+    parts = 0
+    # the part being received: a FileReceiver, a bytearray for a field, None for a skipped part
+    name, current = None, None
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except FormParserError as e:
+                raise HTTPException(status_code=400, detail="Invalid multipart data") from e
+            for kind, value in receiver.events:
+                if kind == "part":
+                    parts += 1
+                    if parts > MAX_PARTS:
+                        raise HTTPException(status_code=400, detail=f"At most {MAX_PARTS} form parts per request")
+                    _, options = parse_options_header(value.get(b"content-disposition", b""))
+                    name = options.get(b"name", b"").decode("utf-8", "replace")
+                    filename = options.get(b"filename")
+                    if filename is None:
+                        current = bytearray()
+                    elif name == FILE_FIELD and filename:
+                        current = FileReceiver()
+                    else:
+                        # browsers send an empty part when no file was picked; other files are ignored
+                        current = None
+                elif kind == "data":
+                    if isinstance(current, FileReceiver):
+                        await current.write(value)
+                    elif current is not None:
+                        current += value
+                        if len(current) > MAX_FIELD_SIZE:
+                            raise HTTPException(status_code=400, detail=f"Form field {name} is larger than {MAX_FIELD_SIZE} bytes")
+                elif isinstance(current, FileReceiver):
+                    receiving, current = current, None
+                    try:
+                        ingested.append(await receiving.finish())
+                    except BaseException:
+                        receiving.abort()
+                        raise
+                elif current is not None:
+                    values[name] = current.decode("utf-8", "replace")
+                    current = None
+            receiver.events.clear()
+        try:
+            parser.finalize()
+        except FormParserError as e:
+            raise HTTPException(status_code=400, detail="Invalid multipart data") from e
+        if current is not None:
+            raise HTTPException(status_code=400, detail="Invalid multipart data")
+    except BaseException:
+        if isinstance(current, FileReceiver):
+            current.abort()
+        raise
+
+
+async def receive_upload_form(request: Request, model: Type[BaseModel], require_files: bool = False) -> UploadForm:
+    # the files under FILE_FIELD are ingested, the other fields validated against model.
+    # on any error the blobs written so far are discarded
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    values: Dict[str, str] = {}
+    ingested: List[IngestedFile] = []
+    try:
+        if content_type == b"multipart/form-data" and b"boundary" in params:
+            await receive_multipart(request, params[b"boundary"], values, ingested)
+        elif content_type == b"application/x-www-form-urlencoded":
+            # fields only, as Form() parameters used to accept
+            values = {key: value for key, value in (await request.form()).items() if isinstance(value, str)}
+        else:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+
+        if require_files and not ingested:
+            raise RequestValidationError([{"type": "missing", "loc": ("body", FILE_FIELD), "msg": "Field required", "input": None}])
+        try:
+            fields = model.model_validate(values)
+        except ValidationError as e:
+            raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()])
+    except BaseException:
+        await discard_new_blobs(ingested)
+        raise
+    return UploadForm(fields=fields, files=ingested)
+
+
+def form_openapi(model: Type[BaseModel]) -> dict:
+    # the request body schema FastAPI would have generated for Form() parameters
+    schema = model.model_json_schema()
+    schema["properties"][FILE_FIELD] = {"type": "array", "items": {"type": "string", "format": "binary"}}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": schema}}}}
+
+
+def remove_copies(ingested: List[IngestedFile]):
+    for file in ingested:
+        if file.tmp_path is not None:
+            try:
+                os.unlink(file.tmp_path)
+            except FileNotFoundError:
+                pass
+            file.tmp_path = None
+
+
+async def store_swept_blobs(ingested: List[IngestedFile]):
+    # after the commit. the sweeper removes a blob's files and row in one transaction, which our
+    # attachment upsert waited for: a blob that was there when we looked may be gone now, and
+    # our refs keep it from being swept again
+    try:
+        for file in ingested:
+            if file.tmp_path is not None and not await storage.exists(file.key):
+                await storage.store(file.key, file.tmp_path)
+                file.tmp_path = None
+                file.created = True
+    finally:
+        remove_copies(ingested)
+
+
+async def discard_new_blobs(ingested: List[IngestedFile]):
+    # undo the blobs a failed request wrote, after its transaction rolled back. created only says
+    # the blob was missing when this request looked: a concurrent upload of the same content may
+    # have stored it too and committed since, so a blob the database knows about stays
+    remove_copies(ingested)
+    new = {file.id: file for file in ingested if file.created}
+    if not new:
+        return
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(AttachmentRef.attachment_id).where(AttachmentRef.attachment_id.in_(new)).
+            union(select(Attachment.id).where(Attachment.id.in_(new))))
+        known = set(result.scalars())
+    for attachment_id, file in new.items():
+        if attachment_id not in known:
+            await storage.delete(file.key)
@@ -12,6 +12,8 @@ from fastapi_users.authentication import (
 from fastapi_users.router.common import ErrorCode
 from fastapi_users import exceptions
 from fastapi_users.db import SQLAlchemyUserDatabase
+from fastapi_users.jwt import decode_jwt
+import jwt
 
 from schemas import UserCreate, UserRead
 
@@ -73,6 +75,23 @@ fastapi_users = FastAPIUsers[User, uuid.UUID](get_user_manager, [api_auth_backen
 current_active_user = fastapi_users.current_user(active=True)
 current_active_user_optional = fastapi_users.current_user(active=True, optional=True)
 
+def token_subject(request: Request) -> Optional[str]:
+    # the user id from the request's bearer token or auth cookie, without a database lookup. for
+    # checks that must run before the route; the route still authenticates the user properly
+    token = None
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        token = credentials
+    else:
+        token = request.cookies.get(cookie_transport.cookie_name)
+    if not token:
+        return None
+    strategy = get_jwt_strategy()
+    try:
+        return decode_jwt(token, strategy.decode_key, strategy.token_audience, algorithms=[strategy.algorithm]).get("sub")
+    except jwt.PyJWTError:
+        return None
+
 async def get_user_by_email(email: str):
     async for user_manager in get_user_manager_manual():
         try:
@@ -0,0 +1,148 @@
+import os
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from PIL import features
+from starlette.concurrency import run_in_threadpool
+
+from imaging import ensure_thumbnail
+from storage import DATA_DIR
+
+VARIANT_DIR = os.path.join(DATA_DIR, "variants")
+VARIANT_CACHE_BYTES = int(os.environ.get("VARIANT_CACHE_BYTES", str(1024 * 1024 * 256))) # 256MB
+VARIANT_WIDTHS = [64, 128, 512]
+
+# format name -> (Pillow format, mime type), in order of preference when negotiating
+VARIANT_FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+if not features.check("avif"):
+    del VARIANT_FORMATS["avif"]
+
+
+def accepted_types(accept: str) -> Dict[str, float]:
+    # media range -> q value, e.g. "image/avif,image/webp;q=0.8,*/*;q=0.5"
+    types = {}
+    for part in accept.split(","):
+        media_type, *params = part.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type.strip():
+            types[media_type.strip().lower()] = q
+    return types
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+    # browsers list the modern formats they decode explicitly, so those only count when named
+    # (not through image/* or */*) with q > 0. the highest q wins, ties go by VARIANT_FORMATS
+    # order, and jpeg is always acceptable
+    types = accepted_types(accept or "")
+    best, best_q = "jpeg", 0.0
+    for fmt, (_, mime_type) in VARIANT_FORMATS.items():
+        q = types.get(mime_type, 0.0)
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class VariantCache:
+    # generated variants on disk, evicted least recently used first once over the byte budget.
+    # recency is tracked in memory only; after a restart mtime is the best guess we have.
+    # each worker keeps its own index, a variant another worker evicted is simply regenerated
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._entries.clear()
+        self.size = 0
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.path, stat.st_size))
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self.size += size
+        self._evict()
+
+    def path_for(self, attachment_id: uuid.UUID, width: int, fmt: str) -> str:
+        return os.path.join(self.directory, f"{attachment_id}_w{width}.{fmt}")
+
+    async def ensure(self, original: str, attachment_id: uuid.UUID, width: int, fmt: str) -> Optional[str]:
+        # original is the storage key of the attachment, variants are kept on local disk
+        path = self.path_for(attachment_id, width, fmt)
+        if path in self._entries and os.path.exists(path):
+            self._entries.move_to_end(path)
+            return path
+        if not os.path.exists(path) and not await ensure_thumbnail(original, path, width, VARIANT_FORMATS[fmt][0], store=False):
+            return None
+        if path not in self._entries:
+            size = os.path.getsize(path)
+            self._entries[path] = size
+            self.size += size
+            self._evict(keep=path)
+        return path
+
+    async def read(self, original: str, attachment_id: uuid.UUID, width: int, fmt: str) -> Optional[bytes]:
+        # the variant's bytes, read before anything can evict it. this worker or another one can
+        # still remove the file between the lookup and the read: that is a cache miss, the entry
+        # is dropped and the variant generated again
+        for _ in range(2):
+            path = await self.ensure(original, attachment_id, width, fmt)
+            if path is None:
+                return None
+            try:
+                return await run_in_threadpool(read_file, path)
+            except FileNotFoundError:
+                if path in self._entries:
+                    self.size -= self._entries.pop(path)
+        return None
+
+    def discard(self, attachment_id: uuid.UUID):
+        # every variant of a deleted attachment, also the ones other workers generated
+        for width in VARIANT_WIDTHS:
+            for fmt in VARIANT_FORMATS:
+                path = self.path_for(attachment_id, width, fmt)
+                if path in self._entries:
+                    self._remove(path)
+                else:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+
+    def _remove(self, path: str):
+        self.size -= self._entries.pop(path)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: Optional[str] = None):
+        while self.size > self.max_bytes and self._entries:
+            path = next(iter(self._entries))
+            if path == keep:
+                break
+            self._remove(path)
+
+
+variant_cache = VariantCache(VARIANT_DIR, VARIANT_CACHE_BYTES)
@@ -0,0 +1,32 @@
+from typing import Dict
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import DataVersion, dialect_insert
+
+
+async def bump(session: AsyncSession, *keys: str):
+    # call inside the writing transaction so the new version becomes visible together with the data
+    for key in keys:
+        stmt = dialect_insert(DataVersion).values(key=key, version=1)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[DataVersion.key],
+            set_={"version": DataVersion.version + 1}))
+
+
+async def current(session: AsyncSession, *keys: str) -> Dict[str, int]:
+    # a key nobody has bumped yet is at version 0
+    result = await session.execute(select(DataVersion.key, DataVersion.version).where(DataVersion.key.in_(keys)))
+    versions = dict.fromkeys(keys, 0)
+    versions.update(result.all())
+    return versions
+
+
+# bumped on any change to the application catalog
+CATALOG = "catalog"
+
+
+def user_key(user_id) -> str:
+    # bumped whenever a user's assignments or submissions change
+    return f"user:{user_id}"
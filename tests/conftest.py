@@ -0,0 +1,112 @@
+# the app reads its configuration at import time, so the test database and data directory are set
+# up here, before anything from app/ is imported
+#
+#   pytest                                                          on a throwaway SQLite file
+#   TEST_DATABASE_URL=postgresql+asyncpg://user@host/db pytest      on Postgres, the database is wiped
+import os
+import sys
+import tempfile
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+TEST_DIR = tempfile.mkdtemp(prefix="scoreboard-test-")
+
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", f"sqlite+aiosqlite:///{TEST_DIR}/test.db")
+os.environ["DATA_DIR"] = os.path.join(TEST_DIR, "data")
+os.environ.setdefault("SECRET", "test-secret-test-secret-test-secret-test")
+os.environ["RUN_MIGRATIONS_ON_STARTUP"] = "true"
+os.environ["SWEEPER_ENABLED"] = "false"
+os.environ["ADMISSION_UPLOAD_RATE"] = "0"
+os.environ["ADMISSION_SUBMISSION_RATE"] = "0"
+os.makedirs(os.environ["DATA_DIR"])
+
+# the modules import each other by their flat names, and main.py serves static/ relative to app/
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
+
+import httpx  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+async def reset_database():
+    from sqlalchemy import text
+    from db import Base, engine, user_cache, attachment_access_cache
+    from migrations import migrate
+    from catalog import catalog
+    import leaderboard
+
+    async with engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            # not part of the models, migration 7 creates it
+            await conn.execute(text("DROP TABLE IF EXISTS submissions_fts"))
+        await conn.run_sync(Base.metadata.drop_all)
+    await migrate()
+    user_cache.clear()
+    attachment_access_cache.clear()
+    leaderboard._boards.clear()
+    catalog.invalidate()
+
+
+@pytest.fixture
+async def database():
+    # a freshly migrated, empty database for every test
+    from db import engine
+
+    await reset_database()
+    yield
+    # every test runs on an event loop of its own, pooled connections can't be carried over
+    await engine.dispose()
+
+
+@pytest.fixture
+async def client(database):
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            yield client
+
+
+async def create_user(email: str, superuser: bool = False):
+    from schemas import UserCreate
+    from users import get_user_manager_manual
+
+    async for manager in get_user_manager_manual():
+        return await manager.create(UserCreate(email=email, password="test-password", is_superuser=superuser))
+
+
+async def login(client: httpx.AsyncClient, email: str) -> dict:
+    response = await client.post("/auth/jwt-api/login", data={"username": email, "password": "test-password"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture
+async def users(client, application):
+    # a superuser, and two participants assigned to the application
+    await create_user("admin@example.com", superuser=True)
+    await create_user("alice@example.com")
+    await create_user("bob@example.com")
+    headers = {email: await login(client, email) for email in ["admin@example.com", "alice@example.com", "bob@example.com"]}
+    response = await client.post("/admin/application_assignments/bulk", json=[
+        {"email": "alice@example.com", "application_id": application},
+        {"email": "bob@example.com", "application_id": application},
+    ], headers=headers["admin@example.com"])
+    assert response.status_code == 200, response.text
+    return headers
+
+
+@pytest.fixture
+async def application(client):
+    from db import Applications, async_session_maker
+
+    async with async_session_maker() as session:
+        application = Applications(name="challenge", is_active=True, description="find the flag", instructions="submit it")
+        session.add(application)
+        await session.commit()
+        return application.id
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from conftest import create_user
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_bulk_application_upsert(client, users):
+    admin = users["admin@example.com"]
+    rows = [{"name": "one", "is_active": True}, {"name": "two", "is_active": False}]
+    response = await client.post("/admin/applications/bulk", content=json.dumps(rows), headers={**admin, "Content-Type": "application/json"})
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == 2, response.text
+
+    rows = [{"name": "one", "is_active": False, "description": "changed"}, {"name": "three", "is_active": True}]
+    response = await client.post("/admin/applications/bulk", content=json.dumps(rows), headers={**admin, "Content-Type": "application/json"})
+    assert response.status_code == 200, response.text
+    assert (response.json()["created"], response.json()["updated"]) == (1, 1)
+
+    response = await client.get("/applications", headers=admin)
+    applications = {application["name"]: application for application in response.json()["applications"]}
+    assert applications["one"]["is_active"] is False
+    assert applications["one"]["description"] == "changed"
+
+
+async def test_bulk_assignment_upsert(client, users, application):
+    admin = users["admin@example.com"]
+    await create_user("carol@example.com")
+    rows = [{"email": "carol@example.com", "application_id": application}, {"email": "alice@example.com", "application_id": application, "is_admin": True}]
+    response = await client.post("/admin/application_assignments/bulk", json=rows, headers=admin)
+    assert response.status_code == 200, response.text
+    assert (response.json()["created"], response.json()["updated"]) == (1, 1)
+
+    response = await client.post("/admin/application_assignments/bulk", json=[{"email": "nobody@example.com", "application_id": application}], headers=admin)
+    assert response.json()["error"] == 1
+
+
+async def test_bulk_import_over_the_row_limit_writes_nothing(client, users, monkeypatch):
+    import admin as admin_module
+
+    monkeypatch.setattr(admin_module, "BULK_MAX_ROWS", 2)
+    monkeypatch.setattr(admin_module, "BULK_BATCH_SIZE", 1)
+    admin = users["admin@example.com"]
+    body = "".join(json.dumps({"name": f"limit {n}"}) + "\n" for n in range(3))
+    response = await client.post("/admin/applications/bulk", content=body, headers={**admin, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 413, response.text
+
+    response = await client.get("/applications", headers=admin)
+    assert not [application for application in response.json()["applications"] if application["name"].startswith("limit")]
+
+    response = await client.post("/admin/applications/bulk", content=body.split("\n", 1)[1], headers={**admin, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == 2
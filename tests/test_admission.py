@@ -0,0 +1,100 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def token_headers():
+    from users import get_jwt_strategy
+
+    token = await get_jwt_strategy().write_token(SimpleNamespace(id=uuid.uuid4()))
+    return [(b"authorization", f"Bearer {token}".encode())]
+
+
+class Endpoint:
+    # reads the body like a route would, optionally holding on until released
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, scope, receive, send):
+        await receive()
+        await self.release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def call(app, headers, path="/upload"):
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(True)
+        return {"type": "http.request", "body": b"x" * 1024, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers, "query_string": b""}
+    await app(scope, receive, send)
+    start = next(message for message in sent if message["type"] == "http.response.start")
+    return start["status"], dict(start["headers"]), bool(received)
+
+
+async def test_rate_limited_before_the_body_is_read():
+    from admission import Admission, AdmissionMiddleware
+
+    controller = Admission("test_rate", concurrency=4, queue=4, timeout=1, rate=0.001, burst=1)
+    app = AdmissionMiddleware(Endpoint(), {("POST", "/upload"): controller})
+    headers = await token_headers()
+
+    assert await call(app, headers) == (200, {}, True)
+    status, response_headers, received = await call(app, headers)
+    assert status == 429
+    assert int(response_headers[b"retry-after"]) >= 1
+    assert not received
+
+    # the bucket is per user
+    status, _, _ = await call(app, await token_headers())
+    assert status == 200
+
+
+async def test_busy_before_the_body_is_read():
+    from admission import Admission, AdmissionMiddleware
+
+    controller = Admission("test_busy", concurrency=1, queue=0, timeout=1, rate=0, burst=1)
+    endpoint = Endpoint()
+    endpoint.release.clear()
+    app = AdmissionMiddleware(endpoint, {("POST", "/upload"): controller})
+
+    first = asyncio.create_task(call(app, await token_headers()))
+    await asyncio.sleep(0.01)
+    status, _, received = await call(app, await token_headers())
+    assert (status, received) == (503, False)
+
+    endpoint.release.set()
+    assert (await first)[0] == 200
+    assert controller.active == 0
+    # other paths are not guarded
+    assert (await call(app, [], path="/other"))[0] == 200
+
+
+async def test_unauthenticated_upload_is_refused_before_the_body(client):
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[("fileAttach", ("a.png", b"x" * 1024, "image/png"))])
+    assert response.status_code == 401
+    response = await client.post("/upload_attachment", headers={"Authorization": "Bearer nonsense"}, files=[("fileAttach", ("a.png", b"x", "image/png"))])
+    assert response.status_code == 401
+
+
+async def test_cookie_authenticated_upload_is_admitted(client, users):
+    response = await client.post("/auth/jwt/login", data={"username": "alice@example.com", "password": "test-password"})
+    assert response.status_code in (200, 204), response.text
+    # the cookie is Secure, the test client would not send it back over http by itself
+    cookie = {"Cookie": f"fastapiusersauth={response.cookies['fastapiusersauth']}"}
+    # past admission, the route itself refuses a file that isn't an image
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[("fileAttach", ("a.png", b"x" * 1024, "image/png"))], headers=cookie)
+    assert response.status_code == 400, response.text
@@ -0,0 +1,116 @@
+import pytest
+from sqlalchemy import inspect, select, text
+
+pytestmark = pytest.mark.anyio
+
+
+def dialect():
+    from db import engine
+    return engine.dialect.name
+
+
+async def test_sqlite_pragmas(database):
+    if dialect() != "sqlite":
+        pytest.skip("SQLite only")
+    from db import SQLITE_BUSY_TIMEOUT, SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE, engine
+
+    async with engine.connect() as conn:
+        assert (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar() == "wal"
+        assert (await conn.exec_driver_sql("PRAGMA busy_timeout")).scalar() == SQLITE_BUSY_TIMEOUT
+        # NORMAL
+        assert (await conn.exec_driver_sql("PRAGMA synchronous")).scalar() == 1
+        # off: User.id is stored in a different format than the uuid columns referencing it
+        assert (await conn.exec_driver_sql("PRAGMA foreign_keys")).scalar() == 0
+        assert (await conn.exec_driver_sql("PRAGMA mmap_size")).scalar() == SQLITE_MMAP_SIZE
+        # negative: KiB rather than pages
+        assert (await conn.exec_driver_sql("PRAGMA cache_size")).scalar() == -SQLITE_CACHE_SIZE
+        # MEMORY
+        assert (await conn.exec_driver_sql("PRAGMA temp_store")).scalar() == 2
+
+
+async def test_postgres_engine(database):
+    if dialect() != "postgresql":
+        pytest.skip("Postgres only")
+    from db import engine
+
+    assert engine.dialect.driver == "asyncpg"
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("SELECT 1"))).scalar() == 1
+
+
+async def test_migrations_applied(database):
+    from db import async_session_maker
+    from migrations import MIGRATIONS, SchemaMigration
+
+    async with async_session_maker() as session:
+        applied = set((await session.execute(select(SchemaMigration.version))).scalars())
+    assert applied == {version for version, _, _ in MIGRATIONS}
+
+
+def table_indexes(conn) -> dict:
+    inspector = inspect(conn)
+    return {
+        table: sorted((index["name"], tuple(index["column_names"])) for index in inspector.get_indexes(table))
+        for table in ("submissions", "attachments", "attachment_refs", "application_assignments")
+    }
+
+
+async def test_index_migrations_upgrade_to_the_model_schema(database):
+    from db import engine
+    from migrations import run_migrations
+
+    async with engine.begin() as conn:
+        expected = await conn.run_sync(table_indexes)
+        # a database from before the index migrations: only the primary key lookups, and
+        # migration 7's search index (an expression, no plain columns)
+        for indexes in expected.values():
+            for name, columns in indexes:
+                if columns != ("id",) and None not in columns:
+                    await conn.exec_driver_sql(f"DROP INDEX {name}")
+        await conn.exec_driver_sql("DELETE FROM schema_migrations WHERE version IN (2, 3, 5, 6)")
+        await conn.run_sync(run_migrations)
+        assert await conn.run_sync(table_indexes) == expected
+
+
+async def test_search_index(database):
+    from db import engine
+
+    async with engine.connect() as conn:
+        if dialect() == "sqlite":
+            result = await conn.execute(text("SELECT name FROM sqlite_master WHERE name = 'submissions_fts'"))
+        else:
+            result = await conn.execute(text("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_submissions_search'"))
+            assert "gin" in result.scalar().lower()
+            return
+        assert result.scalar() == "submissions_fts"
+
+
+async def test_query_plans(database):
+    from db import engine
+    from migrations import check_query_plans
+
+    async with engine.connect() as conn:
+        assert await conn.run_sync(check_query_plans) == []
+
+
+async def test_versions_bump(database):
+    import versions
+    from db import async_session_maker
+
+    async with async_session_maker() as session:
+        await versions.bump(session, "test")
+        await session.commit()
+    async with async_session_maker() as session:
+        await versions.bump(session, "test")
+        await session.commit()
+        assert await versions.current(session, "test", "unknown") == {"test": 2, "unknown": 0}
+
+
+async def test_dialect_insert_do_nothing(database):
+    from db import DataVersion, async_session_maker, dialect_insert
+
+    async with async_session_maker() as session:
+        for version in (1, 5):
+            await session.execute(dialect_insert(DataVersion).values(key="test", version=version).on_conflict_do_nothing())
+        await session.commit()
+        assert (await session.execute(select(DataVersion.version).where(DataVersion.key == "test"))).scalar() == 1
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from conftest import create_user
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_application_updated_only_reaches_assignees(client, users, application):
+    from events import broker
+
+    outsider = await create_user("carol@example.com")
+    response = await client.get("/users/me", headers=users["alice@example.com"])
+    alice = response.json()["id"]
+
+    async with broker.subscribe(alice) as alice_queue, broker.subscribe(str(outsider.id)) as outsider_queue:
+        response = await client.put(f"/applications/{application}", json={"name": "renamed", "is_active": True, "description": "secret", "instructions": "i"}, headers=users["admin@example.com"])
+        assert response.status_code == 200, response.text
+        event = await asyncio.wait_for(alice_queue.get(), 1)
+        assert event["type"] == "application-updated"
+        assert outsider_queue.empty()
+
+
+async def test_own_events_are_not_crowded_out(client, users, application):
+    from events import broker, SUBSCRIBER_QUEUE_SIZE
+
+    alice, bob = users["alice@example.com"], users["bob@example.com"]
+    bob_id = (await client.get("/users/me", headers=bob)).json()["id"]
+
+    # a client that isn't reading: everyone else's submissions never reach its queue
+    async with broker.subscribe(bob_id) as queue:
+        for n in range(SUBSCRIBER_QUEUE_SIZE + 5):
+            response = await client.post("/application_submission", json={"application_id": application, "submission": f"{n}", "attachments": "[]"}, headers=alice)
+            assert response.status_code == 200, response.text
+        assert queue.empty()
+        response = await client.post("/application_submission", json={"application_id": application, "submission": "mine", "attachments": "[]"}, headers=bob)
+        event = queue.get_nowait()
+        assert event["type"] == "submission-created"
+        assert event["submission"]["submission"] == "mine"
+
+
+async def test_recipients(database):
+    from events import recipients
+
+    assert recipients({"type": "broadcast", "user_id": None}) is None
+    assert recipients({"type": "submission-created", "user_id": "someone"}) == {"someone"}
+    assert recipients({"type": "application-updated", "user_id": None, "user_ids": ["a", "b"]}) == {"a", "b"}
@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy import select
+
+pytestmark = pytest.mark.anyio
+
+
+async def submit(client, headers, application_id, text="flag"):
+    response = await client.post("/application_submission", json={"application_id": application_id, "submission": text, "attachments": "[]"}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["submission_id"]
+
+
+async def test_overall_board_is_for_superusers(client, users):
+    response = await client.get("/leaderboard", headers=users["alice@example.com"])
+    assert response.status_code == 403
+    response = await client.get("/leaderboard", headers=users["admin@example.com"])
+    assert response.status_code == 200, response.text
+
+
+async def test_overall_board_follows_application_boards(client, users, application):
+    admin, alice, bob = users["admin@example.com"], users["alice@example.com"], users["bob@example.com"]
+    await submit(client, alice, application)
+    response = await client.get("/leaderboard", headers=admin)
+    assert [(row["email"], row["submission_count"]) for row in response.json()["leaderboard"]] == [("alice@example.com", 1)]
+
+    # each of these changes only an application's board, the cached overall board must still notice
+    await submit(client, bob, application)
+    await submit(client, bob, application)
+    response = await client.get("/leaderboard", headers=admin)
+    assert [(row["email"], row["submission_count"]) for row in response.json()["leaderboard"]] == [("bob@example.com", 2), ("alice@example.com", 1)]
+
+    response = await client.get("/users/me", headers=alice)
+    response = await client.put(f"/applications/{application}/leaderboard/{response.json()['id']}", json={"score": 10}, headers=admin)
+    assert response.status_code == 200, response.text
+    response = await client.get("/leaderboard", headers=admin)
+    assert [(row["email"], row["score"]) for row in response.json()["leaderboard"]] == [("alice@example.com", 10), ("bob@example.com", 0)]
+
+
+async def test_no_global_version_row(client, users, application):
+    from db import DataVersion, async_session_maker
+
+    submission_id = await submit(client, users["alice@example.com"], application)
+    response = await client.delete(f"/application_submission/{submission_id}", headers=users["alice@example.com"])
+    assert response.status_code == 200, response.text
+    async with async_session_maker() as session:
+        keys = set((await session.execute(select(DataVersion.key))).scalars())
+    assert "leaderboard" not in keys
+    assert f"leaderboard:{application}" in keys
+
+
+async def test_leaderboard_upsert(client, users, application):
+    from db import LeaderboardEntry, async_session_maker
+
+    alice = users["alice@example.com"]
+    ids = []
+    for n in range(3):
+        response = await client.post("/application_submission", json={"application_id": application, "submission": f"flag {n}", "attachments": "[]"}, headers=alice)
+        assert response.status_code == 200, response.text
+        ids.append(response.json()["submission_id"])
+    response = await client.delete(f"/application_submission/{ids[0]}", headers=alice)
+    assert response.status_code == 200, response.text
+
+    async with async_session_maker() as session:
+        entries = (await session.execute(select(LeaderboardEntry))).scalars().all()
+    assert [entry.submission_count for entry in entries] == [2]
+
+    response = await client.get(f"/applications/{application}/leaderboard", headers=alice)
+    assert response.status_code == 200, response.text
+    assert [row["submission_count"] for row in response.json()["leaderboard"]] == [2]
@@ -0,0 +1,16 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_route_labels_include_router_prefix(client, users):
+    from metrics import http_requests
+
+    for path in ("/auth/jwt/login", "/auth/jwt-api/login"):
+        await client.post(path, data={"username": "nobody@example.com", "password": "wrong"})
+    await client.get("/users/me", headers=users["alice@example.com"])
+    await client.get("/users/00000000-0000-0000-0000-000000000000", headers=users["admin@example.com"])
+
+    routes = {route for _, route, _ in http_requests._values}
+    assert {"/auth/jwt/login", "/auth/jwt-api/login", "/users/me", "/users/{id}"} <= routes
+    assert not routes & {"/login", "/me", "/{id}"}
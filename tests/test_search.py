@@ -0,0 +1,35 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_search(client, users, application):
+    alice = users["alice@example.com"]
+    for submission in ["the quick brown fox", "a lazy dog", "quick thinking"]:
+        response = await client.post("/application_submission", json={"application_id": application, "submission": submission, "attachments": "[]"}, headers=alice)
+        assert response.status_code == 200, response.text
+
+    admin = users["admin@example.com"]
+    response = await client.get("/submissions/search", params={"q": "quick", "limit": 1}, headers=admin)
+    assert response.status_code == 200, response.text
+    page = response.json()
+    assert len(page["results"]) == 1 and page["next_cursor"]
+    assert "<mark>" in page["results"][0]["snippet"]
+    assert page["results"][0]["email"] == "alice@example.com"
+
+    response = await client.get("/submissions/search", params={"q": "quick", "limit": 1, "cursor": page["next_cursor"]}, headers=admin)
+    assert response.status_code == 200, response.text
+    second = response.json()
+    assert len(second["results"]) == 1 and second["next_cursor"] is None
+    assert second["results"][0]["id"] != page["results"][0]["id"]
+
+    # operators in the input are searched for as text, not a syntax error
+    for q in ['"quick', "NEAR(quick", "quick*", "-quick", "quick OR"]:
+        response = await client.get("/submissions/search", params={"q": q}, headers=admin)
+        assert response.status_code == 200, response.text
+
+    response = await client.get("/submissions/search", params={"q": "  "}, headers=admin)
+    assert response.status_code == 400, response.text
+
+    response = await client.get("/submissions/search", params={"q": "quick"}, headers=alice)
+    assert response.status_code == 403
@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    import boto3
+    import moto
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        boto3.client("s3").create_bucket(Bucket="scoreboard")
+        yield "scoreboard"
+
+
+def blob(content: bytes) -> str:
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    return path
+
+
+async def test_s3_exists_after_another_worker_deletes(bucket):
+    from storage import S3Storage
+
+    # two workers with storages of their own on the same bucket
+    first, second = S3Storage(bucket), S3Storage(bucket)
+    key = "00000000-0000-0000-0000-000000000000.png"
+
+    assert not await first.exists(key)
+    await first.store(key, blob(b"content"))
+    assert await first.exists(key)
+    assert await second.exists(key)
+
+    await second.delete(key)
+    assert not await first.exists(key)
+
+
+async def test_local_store_and_delete():
+    from storage import LocalStorage
+
+    storage = LocalStorage(tempfile.mkdtemp())
+    key = "abcdef00-0000-0000-0000-000000000000.png"
+    await storage.store(key, blob(b"content"))
+    assert storage.path(key).endswith("ab/cd/" + key)
+    async with storage.local_copy(key) as path:
+        assert open(path, "rb").read() == b"content"
+    assert await storage.exists(key)
+    assert b"".join([chunk async for chunk in storage.iter_chunks(key)]) == b"content"
+    await storage.delete(key)
+    assert not await storage.exists(key)
@@ -0,0 +1,133 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+pytestmark = pytest.mark.anyio
+
+
+def png(color=(200, 30, 30)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def upload(client, headers, content: bytes) -> str:
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[("fileAttach", ("a.png", content, "image/png"))], headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["uuids"][0]
+
+
+async def stored(attachment_id: str) -> bool:
+    from storage import storage, original_key
+
+    return await storage.exists(original_key(attachment_id, "image/png"))
+
+
+async def test_unreferenced_uploads_expire(client, users):
+    import sweeper
+
+    alice = users["alice@example.com"]
+    attachment_id = await upload(client, alice, png())
+
+    # still within the grace period
+    assert await sweeper.sweep(grace=3600, pause=0) == sweeper.SweepResult(0, 0)
+    assert await stored(attachment_id)
+
+    assert await sweeper.sweep(grace=0, pause=0) == sweeper.SweepResult(refs=1, attachments=1)
+    assert not await stored(attachment_id)
+    response = await client.get(f"/attachments/data/{attachment_id}", headers=alice)
+    assert response.status_code == 404
+
+
+async def test_referenced_attachments_stay(client, users, application):
+    import sweeper
+
+    alice, bob = users["alice@example.com"], users["bob@example.com"]
+    content = png()
+    response = await client.post("/application_submission/multipart", data={"application_id": str(application), "submission": "s"}, files=[("fileAttach", ("a.png", content, "image/png"))], headers=alice)
+    assert response.status_code == 200, response.text
+    attachment_id = response.json()["uuids"][0]
+    # bob's unused upload of the same content goes, alice's blob stays
+    await upload(client, bob, content)
+
+    assert await sweeper.sweep(grace=0, pause=0) == sweeper.SweepResult(refs=1, attachments=0)
+    assert await stored(attachment_id)
+    response = await client.get(f"/attachments/data/{attachment_id}", headers=alice)
+    assert response.status_code == 200
+    assert response.content == content
+    response = await client.get(f"/attachments/data/{attachment_id}", headers=bob)
+    assert response.status_code == 403
+
+
+async def test_deleted_submission_then_sweep(client, users, application):
+    import sweeper
+
+    alice = users["alice@example.com"]
+    response = await client.post("/application_submission/multipart", data={"application_id": str(application), "submission": "s"}, files=[("fileAttach", ("a.png", png(), "image/png"))], headers=alice)
+    assert response.status_code == 200, response.text
+    submission_id, attachment_id = response.json()["submission_id"], response.json()["uuids"][0]
+
+    response = await client.delete(f"/application_submission/{submission_id}", headers=alice)
+    assert response.status_code == 200, response.text
+    assert await sweeper.sweep(grace=0, pause=0) == sweeper.SweepResult(refs=1, attachments=1)
+    assert not await stored(attachment_id)
+
+
+async def test_upload_during_sweep(client, users, monkeypatch):
+    import sweeper
+    from storage import storage
+
+    alice, bob = users["alice@example.com"], users["bob@example.com"]
+    content = png()
+    attachment_id = await upload(client, alice, content)
+
+    # bob uploads the same content just as the sweeper starts removing it: his upload sees the
+    # blob, then has to wait for the sweep to commit before its refs can go in
+    delete = storage.delete
+    uploads = []
+
+    async def delete_during_upload(key):
+        if not uploads:
+            uploads.append(asyncio.create_task(upload(client, bob, content)))
+            await asyncio.sleep(0.5)
+            assert not uploads[0].done()
+        await delete(key)
+
+    monkeypatch.setattr(storage, "delete", delete_during_upload)
+    assert await sweeper.sweep(grace=0, pause=0) == sweeper.SweepResult(refs=1, attachments=1)
+    assert await uploads[0] == attachment_id
+
+    assert await stored(attachment_id)
+    response = await client.get(f"/attachments/data/{attachment_id}", headers=bob)
+    assert response.status_code == 200
+    assert response.content == content
+
+
+async def test_ref_expired_while_submitting(client, users, application):
+    from datetime import datetime, timedelta
+    from sqlalchemy import event, select
+    from sqlalchemy.util import await_only
+    from db import Submission, async_session_maker, engine
+    import sweeper
+
+    alice = users["alice@example.com"]
+    attachment_id = await upload(client, alice, png())
+
+    # the sweeper expires the unused upload just before the submission's increment runs
+    expired = []
+
+    def expire_first(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE attachment_refs") and not expired:
+            expired.append(await_only(sweeper.expire_refs(datetime.utcnow() + timedelta(seconds=1), 100)))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", expire_first)
+    try:
+        response = await client.post("/application_submission", json={"application_id": application, "submission": "s", "attachments": f'["{attachment_id}"]'}, headers=alice)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", expire_first)
+    assert expired == [1]
+    assert response.status_code == 403, response.text
+    async with async_session_maker() as session:
+        assert (await session.execute(select(Submission))).first() is None
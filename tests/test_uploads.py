@@ -0,0 +1,97 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+pytestmark = pytest.mark.anyio
+
+
+def png(color=(10, 120, 200), size=64) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def staged_files():
+    import asyncio
+    from imaging import _pending
+    from storage import storage
+
+    # thumbnails are rendered through the staging directory too
+    await asyncio.gather(*_pending.values(), return_exceptions=True)
+    return [name for name in os.listdir(storage.staging_dir) if name.endswith(".tmp")]
+
+
+async def test_upload_and_fields(client, users, application):
+    alice = users["alice@example.com"]
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[
+        ("fileAttach", ("a.png", png(), "image/png")),
+        ("fileAttach", ("b.png", png((1, 2, 3)), "image/png")),
+        # what browsers send when no file was picked
+        ("fileAttach", ("", b"", "application/octet-stream")),
+    ], headers=alice)
+    assert response.status_code == 200, response.text
+    assert len(response.json()["uuids"]) == 2
+
+    response = await client.post("/application_submission/multipart", data={"application_id": str(application), "submission": "text"}, files=[("fileAttach", ("a.png", png(), "image/png"))], headers=alice)
+    assert response.status_code == 200, response.text
+    assert await staged_files() == []
+
+
+async def test_upload_validation(client, users):
+    alice = users["alice@example.com"]
+    response = await client.post("/upload_attachment", files=[("fileAttach", ("a.png", png(), "image/png"))], headers=alice)
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "desc"]
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[("fileAttach", ("", b"", "application/octet-stream"))], headers=alice)
+    assert response.status_code == 422
+    response = await client.post("/application_submission/multipart", data={"application_id": "one"}, files=[("fileAttach", ("", b"", "application/octet-stream"))], headers=alice)
+    assert response.status_code == 422
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[("fileAttach", ("a.txt", b"just text" * 2000, "image/png"))], headers=alice)
+    assert response.status_code == 400
+    response = await client.post("/upload_attachment", json={"desc": "x"}, headers=alice)
+    assert response.status_code == 400
+    # without files the fields may come urlencoded, as they could with Form() parameters
+    response = await client.post("/upload_attachment", data={"desc": "x"}, headers=alice)
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "fileAttach"]
+    assert await staged_files() == []
+
+
+async def test_oversize_file_stops_the_read(client, users):
+    from main import app
+    from uploads import MAX_UPLOAD_SIZE
+
+    boundary = "test-boundary"
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"desc\"\r\n\r\nx\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"fileAttach\"; filename=\"a.png\"\r\n"
+            "Content-Type: image/png\r\n\r\n").encode()
+    content = png() + b"\0" * (MAX_UPLOAD_SIZE * 2)
+    body = head + content + f"\r\n--{boundary}--\r\n".encode()
+    chunk_size = 1024 * 64
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    received = 0
+
+    async def receive():
+        nonlocal received
+        received += 1
+        return {"type": "http.request", "body": chunks[received - 1], "more_body": received < len(chunks)}
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    authorization = users["alice@example.com"]["Authorization"].encode()
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "POST", "scheme": "http", "path": "/upload_attachment",
+        "raw_path": b"/upload_attachment", "root_path": "", "query_string": b"", "server": ("test", 80), "client": ("test", 1),
+        "headers": [(b"content-type", f"multipart/form-data; boundary={boundary}".encode()), (b"authorization", authorization),
+                    (b"content-length", str(len(body)).encode())],
+    }
+    await app(scope, receive, send)
+    assert messages[0]["status"] == 400
+    # refused once the file crossed the limit, the rest of the body was never read
+    assert received < len(chunks) // 2 + 2
+    assert await staged_files() == []
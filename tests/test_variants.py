@@ -0,0 +1,53 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from test_uploads import png
+
+pytestmark = pytest.mark.anyio
+
+
+def test_negotiate_format():
+    from variants import VARIANT_FORMATS, negotiate_format
+
+    assert negotiate_format(None) == "jpeg"
+    assert negotiate_format("*/*") == "jpeg"
+    assert negotiate_format("image/*,*/*;q=0.8") == "jpeg"
+    assert negotiate_format("image/webp,*/*") == "webp"
+    assert negotiate_format("image/webp;q=0,*/*") == "jpeg"
+    assert negotiate_format("IMAGE/WEBP ; q=0.5, */*;q=0.1") == "webp"
+    assert negotiate_format("image/webp;q=0.5,image/jpeg") == "jpeg"
+    if "avif" in VARIANT_FORMATS:
+        assert negotiate_format("image/avif,image/webp,*/*") == "avif"
+        assert negotiate_format("image/avif;q=0.5,image/webp") == "webp"
+        assert negotiate_format("image/avif;q=0,image/webp;q=0.1") == "webp"
+
+
+async def test_variant_removed_after_lookup_is_regenerated(client, users, monkeypatch):
+    from variants import variant_cache
+
+    alice = users["alice@example.com"]
+    response = await client.post("/upload_attachment", data={"desc": "x"}, files=[("fileAttach", ("a.png", png(size=256), "image/png"))], headers=alice)
+    assert response.status_code == 200, response.text
+    attachment_id = response.json()["uuids"][0]
+
+    # evicted by another request (or worker) between finding the file and reading it
+    ensure = variant_cache.ensure
+    evicted = []
+
+    async def ensure_then_evict(*args):
+        path = await ensure(*args)
+        if path is not None and not evicted:
+            evicted.append(path)
+            os.unlink(path)
+        return path
+
+    monkeypatch.setattr(variant_cache, "ensure", ensure_then_evict)
+    response = await client.get(f"/attachments/data/{attachment_id}", params={"w": 64, "fmt": "jpeg"}, headers=alice)
+    assert evicted
+    assert response.status_code == 200, response.text
+    assert response.headers["content-type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(response.content)).width == 64
+    assert os.path.exists(evicted[0])